@@ -0,0 +1,419 @@
+"""Benchmarks for filer.
+
+Generates a synthetic tree of files, then times the main stages of indexing
+it: the initial crawl, processing of inotify events, batch visits, raw
+database writes and lookups, and the rescan done on restart.
+
+Results are written as JSON, so runs from different commits can be compared
+with --compare.
+
+Run with:
+
+    python -m filer.bench --files 10000 --output bench.json
+
+"""
+
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import config
+from . import db
+
+
+def file_size(rng, median_size, max_size):
+    """Pick a file size from a log-normal distribution.
+
+    Real trees have lots of small files and a long tail of big ones.
+
+    """
+    if median_size <= 0:
+        return 0
+    size = int(rng.lognormvariate(0, 1.5) * median_size)
+    return min(size, max_size)
+
+
+def write_file(path, size, rng):
+    with open(path, "wb") as fobj:
+        remaining = size
+        while remaining > 0:
+            chunk = min(remaining, 1024 * 128)
+            fobj.write(rng.getrandbits(chunk * 8).to_bytes(chunk, "little"))
+            remaining -= chunk
+
+
+def generate_tree(
+    base,
+    files=1000,
+    depth=3,
+    fanout=4,
+    median_size=4096,
+    max_size=16 * 1024 * 1024,
+    hardlinks=0.0,
+    symlinks=0.0,
+    seed=0,
+):
+    """Create a synthetic tree of files under base.
+
+    Directories are nested `depth` levels deep with `fanout` subdirectories
+    at each level, and files are spread evenly over all the directories.
+    `hardlinks` and `symlinks` are the fraction of extra entries which are
+    links to already created files.
+
+    Returns the list of regular file paths created (not including links).
+
+    """
+    rng = random.Random(seed)
+
+    dirs = [base]
+    level = [base]
+    for d in range(depth):
+        next_level = []
+        for parent in level:
+            for i in range(fanout):
+                path = os.path.join(parent, "d{}_{}".format(d, i))
+                next_level.append(path)
+        dirs.extend(next_level)
+        level = next_level
+    for path in dirs:
+        os.makedirs(path, exist_ok=True)
+
+    paths = []
+    for i in range(files):
+        path = os.path.join(dirs[i % len(dirs)], "f{}".format(i))
+        write_file(path, file_size(rng, median_size, max_size), rng)
+        paths.append(path)
+
+    if paths:
+        for i in range(int(files * hardlinks)):
+            target = rng.choice(paths)
+            os.link(target, os.path.join(rng.choice(dirs), "h{}".format(i)))
+        for i in range(int(files * symlinks)):
+            target = rng.choice(paths)
+            os.symlink(target, os.path.join(rng.choice(dirs), "s{}".format(i)))
+
+    return paths
+
+
+def churn_tree(
+    paths, fraction=0.1, median_size=4096, max_size=16 * 1024 * 1024, seed=1
+):
+    """Modify, create and delete a fraction of the files in a tree.
+
+    Changes are split evenly between the three kinds.  Returns a dict of
+    counts of each kind of change, and the number of paths changed in total.
+
+    """
+    rng = random.Random(seed)
+    count = int(len(paths) * fraction)
+    chosen = rng.sample(paths, min(count, len(paths)))
+    counts = {"modified": 0, "created": 0, "deleted": 0}
+    for i, path in enumerate(chosen):
+        kind = i % 3
+        if kind == 0:
+            write_file(path, file_size(rng, median_size, max_size), rng)
+            counts["modified"] += 1
+        elif kind == 1:
+            new_path = "{}.new{}".format(path, i)
+            write_file(new_path, file_size(rng, median_size, max_size), rng)
+            paths.append(new_path)
+            counts["created"] += 1
+        else:
+            os.unlink(path)
+            paths.remove(path)
+            counts["deleted"] += 1
+    counts["total"] = len(chosen)
+    return counts
+
+
+def make_config(root, db_dir):
+    return config.load_config_from_data(
+        {"roots": [root], "db": {"dir": db_dir}, "times": {"settle": 0}}
+    )
+
+
+@contextlib.contextmanager
+def timed(results, name):
+    """Time a block, storing the elapsed time in results[name].
+
+    The block may set "items" in the yielded dict to get a rate calculated.
+
+    """
+    result = {}
+    start = time.perf_counter()
+    yield result
+    elapsed = time.perf_counter() - start
+    result["seconds"] = elapsed
+    if "items" in result and elapsed > 0:
+        result["rate"] = result["items"] / elapsed
+    results[name] = result
+
+
+def fake_hash(i):
+    return hashlib.sha256(str(i).encode("utf8")).hexdigest()
+
+
+def bench_db(results, db_config, rows, batch_size):
+    """Time raw writes and lookups against a fresh database."""
+    conn = db.connect(db_config, read_only=False)
+    db.init_schema(conn)
+    now = int(time.time())
+    paths = ["/bench/d{}/f{}".format(i % 100, i) for i in range(rows)]
+
+    with timed(results, "db_write") as result:
+        for i, path in enumerate(paths):
+            db.update_file_data(conn, fake_hash(i), i, path, now, now)
+            if i % batch_size == batch_size - 1:
+                conn.commit()
+        conn.commit()
+        result["items"] = rows
+
+    with timed(results, "db_lookup") as result:
+        for start in range(0, rows, batch_size):
+            db.get_current_file_data(conn, paths[start : start + batch_size])
+        result["items"] = rows
+
+    conn.close()
+
+
+def run_until_quiet(loop, is_done, timeout):
+    """Run the loop until is_done() returns true, or the timeout passes."""
+    deadline = time.time() + timeout
+
+    async def wait():
+        while not is_done() and time.time() < deadline:
+            await asyncio.sleep(0.01)
+
+    loop.run_until_complete(wait())
+
+
+def make_walker(walker_config):
+    from .walker import Walker
+
+    class BenchWalker(Walker):
+        """Walker which counts changes rather than logging them."""
+
+        changes_seen = 0
+
+        def log(self, message):
+            pass
+
+        async def process_change(self, path, stats):
+            self.changes_seen += 1
+            await super().process_change(path, stats)
+
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    walker = BenchWalker(walker_config)
+    walker.init_delete_batch_processing()
+    walker.init_file_batch_processing()
+    walker.init_symlink_batch_processing()
+    walker.revisit_cond = asyncio.Condition()
+    return walker
+
+
+def flush_batches(walker):
+    walker.loop.run_until_complete(walker.process_file_batch())
+    walker.loop.run_until_complete(walker.process_symlink_batch())
+    walker.loop.run_until_complete(walker.process_delete_batch())
+
+
+def close_walker(walker):
+    for task in asyncio.all_tasks(walker.loop):
+        task.cancel()
+    walker.loop.run_until_complete(asyncio.sleep(0))
+    if walker.notifier is None:
+        # Stopping the notifier closes the watch manager itself.
+        walker.watch_manager.close()
+    walker.db_conn.close()
+    walker.loop.close()
+
+
+def bench_walker(results, root, db_dir, paths, args):
+    """Time the walker over the synthetic tree."""
+    walker_config = make_config(root, os.path.join(db_dir, "walker"))
+    walker = make_walker(walker_config)
+
+    with timed(results, "initial_crawl") as result:
+        walker.loop.run_until_complete(walker.start_watching_roots())
+        flush_batches(walker)
+        result["items"] = walker.changes_seen
+
+    walker.start_polling_changes()
+    walker.changes_seen = 0
+    with timed(results, "inotify_churn") as result:
+        counts = churn_tree(
+            paths, args.churn, args.median_size, args.max_size, args.seed + 1
+        )
+        # Each changed path produces at least one event.
+        run_until_quiet(
+            walker.loop,
+            lambda: walker.changes_seen >= counts["total"],
+            args.timeout,
+        )
+        flush_batches(walker)
+        result["items"] = walker.changes_seen
+        result["changes"] = counts
+    walker.stop_polling_changes()
+    close_walker(walker)
+
+    visit_config = make_config(root, os.path.join(db_dir, "visit"))
+    walker = make_walker(visit_config)
+    batch = [(path, int(os.path.getmtime(path))) for path in sorted(paths)]
+    batches = [
+        batch[i : i + walker.batch_size]
+        for i in range(0, len(batch), walker.batch_size)
+    ]
+    for name in ("visit_files_new", "visit_files_unchanged"):
+        with timed(results, name) as result:
+            for batch in batches:
+                walker.loop.run_until_complete(walker.visit_files(batch))
+            result["items"] = len(paths)
+    close_walker(walker)
+
+    walker = make_walker(walker_config)
+    with timed(results, "restart_rescan") as result:
+        walker.loop.run_until_complete(walker.start_watching_roots())
+        flush_batches(walker)
+        result["items"] = walker.changes_seen
+    close_walker(walker)
+
+
+def git_commit():
+    try:
+        result = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+    except OSError:
+        return None
+    if result.returncode != 0:
+        return None
+    return result.stdout.decode("utf8").strip()
+
+
+def run_benchmarks(args):
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="filer-bench-", dir=args.workdir)
+    try:
+        root = os.path.join(workdir, "tree")
+        db_dir = os.path.join(workdir, "db")
+
+        with timed(results, "generate_tree") as result:
+            paths = generate_tree(
+                root,
+                files=args.files,
+                depth=args.depth,
+                fanout=args.fanout,
+                median_size=args.median_size,
+                max_size=args.max_size,
+                hardlinks=args.hardlinks,
+                symlinks=args.symlinks,
+                seed=args.seed,
+            )
+            result["items"] = len(paths)
+
+        with open(os.devnull, "w") as devnull:
+            with contextlib.redirect_stdout(devnull):
+                bench_db(
+                    results,
+                    make_config(root, os.path.join(db_dir, "raw")),
+                    args.db_rows,
+                    args.batch_size,
+                )
+                if not args.skip_walker:
+                    bench_walker(results, root, db_dir, paths, args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "params": vars(args),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "commit": git_commit(),
+        },
+        "results": results,
+    }
+
+
+def compare(old, new):
+    """Return lines describing how the rates in new differ from old."""
+    lines = []
+    for name, result in sorted(new["results"].items()):
+        old_result = old["results"].get(name)
+        if old_result is None or "rate" not in result or "rate" not in old_result:
+            continue
+        ratio = result["rate"] / old_result["rate"] if old_result["rate"] else 0
+        lines.append(
+            "{:24} {:12.1f}/s -> {:12.1f}/s  ({:+.1%})".format(
+                name, old_result["rate"], result["rate"], ratio - 1
+            )
+        )
+    return lines
+
+
+def run():
+    parser = argparse.ArgumentParser(description="Benchmark filer.")
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--median-size", type=int, default=4096)
+    parser.add_argument("--max-size", type=int, default=16 * 1024 * 1024)
+    parser.add_argument(
+        "--hardlinks", type=float, default=0.0, help="Fraction of extra hardlinks"
+    )
+    parser.add_argument(
+        "--symlinks", type=float, default=0.0, help="Fraction of extra symlinks"
+    )
+    parser.add_argument(
+        "--churn", type=float, default=0.1, help="Fraction of files to change"
+    )
+    parser.add_argument("--db-rows", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        default=60,
+        help="Maximum time to wait for inotify events",
+    )
+    parser.add_argument(
+        "--skip-walker",
+        action="store_true",
+        help="Only run the database benchmarks",
+    )
+    parser.add_argument("--workdir", help="Directory to build the test tree in")
+    parser.add_argument("--output", help="File to write JSON results to")
+    parser.add_argument("--compare", help="Earlier JSON results to compare with")
+
+    args = parser.parse_args()
+    output = run_benchmarks(args)
+
+    if args.output:
+        with open(args.output, "w") as fobj:
+            json.dump(output, fobj, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+    if args.compare:
+        with open(args.compare) as fobj:
+            old = json.load(fobj)
+        for line in compare(old, output):
+            print(line, file=sys.stderr)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,58 @@
+from . import bench
+import argparse
+import os
+import pytest
+
+
+def test_generate_tree(tmp_path):
+    base = str(tmp_path / "tree")
+    paths = bench.generate_tree(
+        base, files=50, depth=2, fanout=3, hardlinks=0.1, symlinks=0.1, seed=3
+    )
+    assert len(paths) == 50
+    assert all(os.path.isfile(path) for path in paths)
+    links = [name for _, _, names in os.walk(base) for name in names if name[0] in "hs"]
+    assert len(links) == 10
+
+    # Generation is reproducible
+    sizes = [os.path.getsize(path) for path in paths]
+    other = bench.generate_tree(str(tmp_path / "other"), files=50, depth=2, seed=3)
+    assert [os.path.getsize(path) for path in other] == sizes
+
+
+def test_churn_tree(tmp_path):
+    paths = bench.generate_tree(str(tmp_path), files=30, depth=1, fanout=2)
+    counts = bench.churn_tree(paths, fraction=0.5)
+    assert counts == {"modified": 5, "created": 5, "deleted": 5, "total": 15}
+    assert len(paths) == 30
+    assert all(os.path.isfile(path) for path in paths)
+
+
+def test_bench_db(tmp_path):
+    results = {}
+    db_config = bench.make_config(str(tmp_path), str(tmp_path / "db"))
+    bench.bench_db(results, db_config, rows=100, batch_size=30)
+    assert results["db_write"]["items"] == 100
+    assert results["db_lookup"]["items"] == 100
+
+
+def test_compare():
+    old = {"results": {"a": {"rate": 100.0}, "b": {"seconds": 1}}}
+    new = {"results": {"a": {"rate": 150.0}, "b": {"seconds": 2}}}
+    lines = bench.compare(old, new)
+    assert len(lines) == 1
+    assert "+50.0%" in lines[0]
+
+
+def test_bench_walker(tmp_path):
+    pytest.importorskip("pyinotify")
+    root = str(tmp_path / "tree")
+    paths = bench.generate_tree(root, files=20, depth=1, fanout=2, max_size=4096)
+    args = argparse.Namespace(
+        churn=0.2, median_size=512, max_size=4096, seed=0, timeout=10
+    )
+    results = {}
+    bench.bench_walker(results, root, str(tmp_path / "db"), paths, args)
+    assert results["initial_crawl"]["items"] == 20
+    assert results["visit_files_new"]["items"] == 20
+    assert "restart_rescan" in results
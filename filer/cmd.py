@@ -1,6 +1,41 @@
 import argparse
+import json
+import os
+import sys
 from . import config
-from .walker import Walker
+from . import db
+from . import feed
+
+
+def show_duplicates(config, min_size, prefixes):
+    if prefixes:
+        # Stored paths are absolute, with the roots' symlinks resolved.
+        prefixes = [os.path.realpath(prefix) for prefix in prefixes]
+    conn = db.connect(config)
+    groups = 0
+    wasted = 0
+    try:
+        for content_hash, filesize, paths, group_wasted in db.get_duplicate_files(
+            conn, min_size, prefixes
+        ):
+            print(
+                json.dumps(
+                    {
+                        "hash": content_hash,
+                        "size": filesize,
+                        "paths": paths,
+                        "wasted": group_wasted,
+                    }
+                )
+            )
+            groups += 1
+            wasted += group_wasted
+    finally:
+        conn.close()
+    print(
+        "{} groups of duplicates, {} bytes wasted".format(groups, wasted),
+        file=sys.stderr,
+    )
 
 
 def run():
@@ -15,6 +50,32 @@ def run():
         action="store_true",
         help="Display the configuration that will be used",
     )
+    parser.add_argument(
+        "--duplicates",
+        action="store_true",
+        help="List groups of files with identical contents, as JSON lines",
+    )
+    parser.add_argument(
+        "--min-size",
+        type=int,
+        default=1,
+        help="Ignore files smaller than this when listing duplicates",
+    )
+    parser.add_argument(
+        "--under",
+        action="append",
+        metavar="DIR",
+        help="Only list duplicates under this directory (may be repeated)",
+    )
+    parser.add_argument(
+        "--follow-changes",
+        type=int,
+        nargs="?",
+        const=0,
+        metavar="SEQ",
+        help="Print content changes after sequence number SEQ as JSON lines, "
+        "then follow new changes as they happen",
+    )
 
     args = parser.parse_args()
 
@@ -30,11 +91,23 @@ def run():
         import pprint
 
         print("Configuration:\n")
-        for key, value in config.config._asdict().items():
+        for key, value in config.get_config()._asdict().items():
             print(key, end=" = ")
             pprint.pprint(value)
         print()
         return
 
-    walker = Walker(config.config)
+    if args.follow_changes is not None:
+        socket_path = feed.socket_path(config.get_config())
+        for change in feed.follow(socket_path, args.follow_changes):
+            print(json.dumps(change), flush=True)
+        return
+
+    if args.duplicates:
+        show_duplicates(config.get_config(), args.min_size, args.under)
+        return
+
+    from .walker import Walker
+
+    walker = Walker(config.get_config())
     walker.listen()
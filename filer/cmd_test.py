@@ -0,0 +1,23 @@
+from . import cmd
+from . import config
+from . import db
+import json
+import os
+
+
+def test_duplicates_under_relative_dir(tmp_path, conn, capsys, monkeypatch):
+    root = os.path.realpath(str(tmp_path))
+    for path in ("r/a", "r/b", "other/c"):
+        db.update_file_data(conn, "h1", 10, os.path.join(root, path), 100, 1)
+    conn.commit()
+
+    os.makedirs(os.path.join(root, "r"))
+    monkeypatch.chdir(os.path.join(root, "r"))
+    cmd.show_duplicates(
+        config.load_config_from_data({"db": {"dir": str(tmp_path)}}), 1, ["."]
+    )
+    out, err = capsys.readouterr()
+    assert [json.loads(line)["paths"] for line in out.splitlines()] == [
+        [os.path.join(root, "r/a"), os.path.join(root, "r/b")]
+    ]
+    assert err == "1 groups of duplicates, 10 bytes wasted\n"
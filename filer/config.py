@@ -25,6 +25,24 @@ Config = namedtuple(
         "exclude_patterns",
         "db_dir",
         "settle_time",
+        "settle_min_time",
+        "settle_max_time",
+        "settle_overrides",
+        "io",
+        "profile_duration",
+    ],
+)
+
+IOConfig = namedtuple(
+    "IOConfig",
+    [
+        "read_bytes_per_second",
+        "files_per_second",
+        "idle_priority",
+        "adaptive",
+        "target_latency",
+        "small_file_size",
+        "limits",
     ],
 )
 
@@ -40,7 +58,11 @@ def check_list_of_strings(data, name):
 def load_config_from_path(path):
     with open(path, "rb") as fobj:
         data = json.load(fobj)
+    return load_config_from_data(data, path)
+
 
+def load_config_from_data(data, path=None):
+    data = dict(data)
     datadir = data.pop("datadir", None)
     roots = data.pop(
         "roots",
@@ -50,7 +72,7 @@ def load_config_from_path(path):
     )
     check_list_of_strings(roots, "roots")
 
-    excludes = data.pop("exclude", {})
+    excludes = dict(data.pop("exclude", {}))
     exclude_paths = excludes.pop("paths", [])
     check_list_of_strings(exclude_paths, "exclude.paths")
     exclude_directories = excludes.pop("directories", [])
@@ -58,11 +80,37 @@ def load_config_from_path(path):
     exclude_patterns = excludes.pop("patterns", [])
     check_list_of_strings(exclude_patterns, "exclude.patterns")
 
-    db_config = data.pop("db", {})
+    db_config = dict(data.pop("db", {}))
     db_dir = os.path.abspath(os.path.expanduser(db_config.pop("dir", "~/.filer")))
 
-    times = data.pop("times", {})
+    times = dict(data.pop("times", {}))
     settle_time = max(float(times.pop("settle", 30.0)), 0.0)
+    settle_min_time = min(max(float(times.pop("settle_min", 5.0)), 0.0), settle_time)
+    settle_max_time = max(float(times.pop("settle_max", 3600.0)), settle_time)
+    # Kept in the config's order, as the first matching pattern wins.
+    settle_overrides = [
+        (pattern, max(float(seconds), 0.0))
+        for pattern, seconds in times.pop("settle_overrides", {}).items()
+    ]
+    profile_duration = max(float(times.pop("profile_duration", 60.0)), 0.0)
+
+    io_data = dict(data.pop("io", {}))
+    io = IOConfig(
+        read_bytes_per_second=io_data.pop("read_bytes_per_second", None),
+        files_per_second=io_data.pop("files_per_second", None),
+        idle_priority=bool(io_data.pop("idle_priority", False)),
+        adaptive=bool(io_data.pop("adaptive", False)),
+        target_latency=float(io_data.pop("target_latency", 0.05)),
+        small_file_size=int(io_data.pop("small_file_size", 1024 * 1024)),
+        limits=io_data.pop("limits", {}),
+    )
+    for path, limits in io.limits.items():
+        unknown = set(limits.keys()) - {"read_bytes_per_second", "files_per_second"}
+        if unknown:
+            print(
+                "Warning: unknown io limits for {}: {}".format(path, repr(unknown)),
+                file=sys.stderr,
+            )
 
     if len(data) != 0:
         print(
@@ -84,6 +132,11 @@ def load_config_from_path(path):
             "Warning: unknown times items: {}".format(repr(times.keys())),
             file=sys.stderr,
         )
+    if len(io_data) != 0:
+        print(
+            "Warning: unknown io items: {}".format(repr(io_data.keys())),
+            file=sys.stderr,
+        )
 
     return Config(
         path,
@@ -93,6 +146,11 @@ def load_config_from_path(path):
         exclude_patterns,
         db_dir,
         settle_time,
+        settle_min_time,
+        settle_max_time,
+        settle_overrides,
+        io,
+        profile_duration,
     )
 
 
@@ -113,4 +171,12 @@ def config_paths():
     return [os.path.abspath(path) for path in CONFIG_PATHS]
 
 
-config = load_config()
+_config = None
+
+
+def get_config():
+    """Return the configuration, loading it the first time this is called."""
+    global _config
+    if _config is None:
+        _config = load_config()
+    return _config
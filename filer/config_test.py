@@ -12,3 +12,11 @@ def test_load_config():
     assert value.roots == ["/"]
     with pytest.raises(AttributeError) as e:
         value.invalid_value
+
+
+def test_times():
+    value = config.load_config_from_data({})
+    assert value.settle_time == 30.0
+    assert value.profile_duration == 60.0
+    value = config.load_config_from_data({"times": {"profile_duration": 5}})
+    assert value.profile_duration == 5.0
@@ -0,0 +1,31 @@
+from . import config
+from . import db
+import pytest
+
+
+@pytest.fixture
+def make_conn(tmp_path):
+    """Return a function which opens a writable db with the schema set up.
+
+    The db is put in tmp_path/name, or in tmp_path itself by default.
+
+    """
+    conns = []
+
+    def make(name=""):
+        conn = db.connect(
+            config.load_config_from_data({"db": {"dir": str(tmp_path / name)}}),
+            read_only=False,
+        )
+        db.init_schema(conn)
+        conns.append(conn)
+        return conn
+
+    yield make
+    for conn in conns:
+        conn.close()
+
+
+@pytest.fixture
+def conn(make_conn):
+    return make_conn()
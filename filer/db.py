@@ -1,9 +1,28 @@
+import hashlib
+import json
 import sqlite3
 import urllib.parse
 import os
 
 DB_FILENAME = "db.sqlite"
 
+# Bumped when what goes into directory summaries changes, so that the
+# summaries in existing databases are recalculated.
+DIR_SUMMARY_VERSION = 2
+
+# Columns added to tables after they were first created, which need to be
+# added to existing databases.
+ADDED_COLUMNS = {
+    "dirs": (
+        ("content_hash", "text"),
+        ("total_size", "integer"),
+        ("file_count", "integer"),
+        ("content_changed", "integer"),
+        ("dirty", "integer"),
+        ("mtime", "integer"),
+    ),
+}
+
 
 def db_uri(path, read_only):
     """Calculate the database URI"""
@@ -13,7 +32,7 @@ def db_uri(path, read_only):
     return uri
 
 
-def connect(config, read_only=True):
+def connect(config, read_only=True, check_same_thread=True):
     """Connect to the database"""
     db_dir = config.db_dir
     db_path = os.path.join(db_dir, DB_FILENAME)
@@ -22,11 +41,38 @@ def connect(config, read_only=True):
         if not os.path.exists(db_dir):
             os.makedirs(db_dir)
 
-    return sqlite3.connect(db_uri(db_path, read_only), uri=True)
+    return sqlite3.connect(
+        db_uri(db_path, read_only), uri=True, check_same_thread=check_same_thread
+    )
+
+
+def _add_missing_columns(cursor):
+    """Add columns which are missing from tables created by older versions.
+
+    New columns in the dirs table mean the directory summaries need to be
+    calculated, so all dirs are marked dirty in that case.
+
+    """
+    for table, columns in ADDED_COLUMNS.items():
+        cursor.execute("pragma table_info({})".format(table))
+        existing = set(row[1] for row in cursor.fetchall())
+        if len(existing) == 0:
+            # Table doesn't exist yet
+            continue
+        added = False
+        for name, column_type in columns:
+            if name not in existing:
+                cursor.execute(
+                    "alter table {} add column {} {}".format(table, name, column_type)
+                )
+                added = True
+        if added and table == "dirs":
+            cursor.execute("update dirs set dirty = 1")
 
 
 def init_schema(connection):
     cursor = connection.cursor()
+    _add_missing_columns(cursor)
     for sql in (
         """
         pragma journal_mode=WAL;
@@ -38,6 +84,12 @@ def init_schema(connection):
           parent_id integer,
           first_observed integer,
           deleted_before integer,
+          content_hash text,
+          total_size integer,
+          file_count integer,
+          content_changed integer,
+          dirty integer,
+          mtime integer,
           foreign key(parent_id) references dirs(id)
         );
         """,
@@ -54,12 +106,45 @@ def init_schema(connection):
         );
         """,
         """
+        create table if not exists symlinks (
+          path text,
+          target text,
+          dir_id integer,
+          first_observed integer,
+          deleted_before integer,
+          foreign key(dir_id) references dirs(id)
+        );
+        """,
+        """
+        create table if not exists meta (
+          key text primary key,
+          value integer
+        ) without rowid;
+        """,
+        """
+        create table if not exists changes (
+          seq integer primary key autoincrement,
+          path text,
+          old_hash text,
+          new_hash text,
+          event text,
+          timestamp integer
+        );
+        """,
+        """
         create table if not exists visits (
           path text primary key,
           revisit_time integer
         ) without rowid;
         """,
         """
+        create table if not exists crawls (
+          root text primary key,
+          frontier text,
+          updated integer
+        ) without rowid;
+        """,
+        """
         create index if not exists idx_current_file_hashes on files (
           hash,
           path,
@@ -77,26 +162,133 @@ def init_schema(connection):
           path,
           revisit_time
         ) where revisit_time is not null;
+    """,
+        """
+        create index if not exists idx_current_symlinks on symlinks (
+          path,
+          target
+        ) where deleted_before is null;
+    """,
+        """
+        create index if not exists idx_current_file_paths on files (
+          path
+        ) where deleted_before is null;
+    """,
+        """
+        create index if not exists idx_current_files_by_dir on files (
+          dir_id
+        ) where deleted_before is null;
+    """,
+        """
+        create index if not exists idx_current_symlinks_by_dir on symlinks (
+          dir_id
+        ) where deleted_before is null;
+    """,
+        """
+        create index if not exists idx_dirs_by_parent on dirs (
+          parent_id
+        ) where deleted_before is null;
+    """,
+        """
+        create index if not exists idx_dir_content_hashes on dirs (
+          content_hash,
+          path
+        ) where deleted_before is null;
+    """,
+        """
+        create index if not exists idx_dirty_dirs on dirs (
+          id
+        ) where dirty = 1;
     """,
     ):
-        print(sql)
         cursor.execute(sql)
 
+    if get_counter(connection, "dir_summary_version") < DIR_SUMMARY_VERSION:
+        cursor.execute("update dirs set dirty = 1")
+        cursor.execute(
+            "insert or replace into meta (key, value) values(?, ?)",
+            ("dir_summary_version", DIR_SUMMARY_VERSION),
+        )
+
     cursor.close()
     connection.commit()
 
 
-def clear_visits(connection):
-    """Clear the visits table.
+def clear_visits(connection, root=None):
+    """Clear the visits table, or just the visits to paths under root.
 
-    This is done before starting a new walk of the full tree.
+    This is done before starting a new walk of the full tree (or of a root).
 
     This allows the files which aren't seen in a walk to be determined.
 
     """
     cursor = connection.cursor()
     try:
-        cursor.execute("delete from visits;")
+        if root is None:
+            cursor.execute("delete from visits;")
+        else:
+            root = root.rstrip("/")
+            # "0" is the character after "/", so this is every path under root.
+            cursor.execute(
+                """
+                delete from visits
+                where path = ?
+                or (path >= ? and path < ?)
+            """,
+                (root, root + "/", root + "0"),
+            )
+    finally:
+        cursor.close()
+
+
+def save_crawl_frontier(connection, root, frontier, now):
+    """Record the directories still to be listed by the crawl of a root.
+
+    An empty frontier records that the walk of the root has finished, but
+    the crawl as a whole hasn't been completed.
+
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            insert or replace into crawls (root, frontier, updated)
+            values(?, ?, ?)
+        """,
+            (root, json.dumps(list(frontier)), now),
+        )
+    finally:
+        cursor.close()
+
+
+def get_crawl_frontier(connection, root):
+    """Return the saved frontier of an interrupted crawl of root, or None."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute("select frontier from crawls where root = ?", (root,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+    finally:
+        cursor.close()
+
+
+def crawl_in_progress(connection):
+    """Return True if a crawl was interrupted before being completed."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute("select 1 from crawls limit 1")
+        return cursor.fetchone() is not None
+    finally:
+        cursor.close()
+
+
+def clear_crawl_progress(connection):
+    """Forget the progress of the crawl, once it has been completed."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute("delete from crawls")
     finally:
         cursor.close()
 
@@ -189,8 +381,34 @@ def get_unvisited_files(connection):
         cursor.close()
 
 
+def get_unvisited_symlinks(connection):
+    """Return an iterator over symlinks which exist in the DB but haven't been
+    visited yet.
+
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            select symlinks.path
+            from symlinks
+            left outer join visits
+            on symlinks.path = visits.path
+            where visits.path is null
+            and symlinks.deleted_before is null
+        """
+        )
+        while True:
+            items = cursor.fetchmany()
+            if len(items) == 0:
+                break
+            for item in items:
+                yield item[0]
+    finally:
+        cursor.close()
+
+
 def get_current_file_data(connection, paths):
-    print("Get current: %r" % (paths,))
     cursor = connection.cursor()
     try:
         args = ", ".join(["?"] * len(paths))
@@ -210,24 +428,132 @@ def get_current_file_data(connection, paths):
         cursor.close()
 
 
+def get_file_records(connection, paths=None, history=False):
+    """Return an iterator over files, as (path, hash, filesize, mtime,
+    first_observed, deleted_before) tuples.
+
+    Only current files are included, unless history is True.  If paths is
+    given, only files with those paths are included.
+
+    """
+    cursor = connection.cursor()
+    try:
+        sql = """
+            select path, hash, filesize, mtime, first_observed, deleted_before
+            from files
+        """
+        if not history:
+            sql += " where deleted_before is null"
+        if paths is None:
+            cursor.execute(sql)
+        else:
+            paths = list(paths)
+            cursor.execute(
+                sql
+                + (" and " if not history else " where ")
+                + "path in ({})".format(",".join("?" for _ in paths)),
+                paths,
+            )
+        while True:
+            items = cursor.fetchmany()
+            if len(items) == 0:
+                break
+            yield from items
+    finally:
+        cursor.close()
+
+
+def batches(items, size):
+    """Yield lists of up to size items from an iterable."""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def is_under(path, prefixes):
+    """Return True if path is one of prefixes, or inside one of them."""
+    for prefix in prefixes:
+        prefix = prefix.rstrip("/")
+        if path == prefix or path.startswith(prefix + "/"):
+            return True
+    return False
+
+
+def _duplicate_group(content_hash, filesize, paths):
+    return content_hash, filesize, paths, (filesize or 0) * (len(paths) - 1)
+
+
+def get_duplicate_files(connection, min_size=0, prefixes=None):
+    """Return an iterator over groups of current files with the same content.
+
+    Each group is a (hash, filesize, paths, wasted_bytes) tuple, where
+    wasted_bytes is the space used by all but one of the copies.  Only files
+    of at least min_size bytes, and (if prefixes is given) under one of the
+    directories in prefixes, are included.
+
+    This walks the hash index in order, so only one group is held in memory
+    at a time.
+
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            select hash, path, filesize
+            from files indexed by idx_current_file_hashes
+            where deleted_before is null
+            and filesize >= ?
+            order by hash, path
+        """,
+            (min_size,),
+        )
+        group_hash = None
+        group_size = None
+        group = []
+        while True:
+            items = cursor.fetchmany()
+            if len(items) == 0:
+                break
+            for content_hash, path, filesize in items:
+                if prefixes is not None and not is_under(path, prefixes):
+                    continue
+                if content_hash != group_hash:
+                    if len(group) > 1:
+                        yield _duplicate_group(group_hash, group_size, group)
+                    group_hash = content_hash
+                    group_size = filesize
+                    group = []
+                group.append(path)
+        if len(group) > 1:
+            yield _duplicate_group(group_hash, group_size, group)
+    finally:
+        cursor.close()
+
+
 def _update_dir_data(cursor, path, now):
     """Ensure that there's a record of a directory existing now, and return its id.
 
+    Paths are unique in dirs, so a directory which reappears after being
+    deleted gets its old record back.
+
     """
     is_root = (path == '/' or path == '')
     cursor.execute(
         """
-        select id, parent_id, first_observed
+        select id, deleted_before
         from dirs
         where path = ?
-        and deleted_before is null
     """,
     (path,),
     )
     rows = cursor.fetchall()
-    if len(rows) > 0:
-        assert len(rows) == 1
-        old_dir_id, _, _ = rows[0]
+    if len(rows) > 0 and rows[0][1] is None:
+        old_dir_id, _ = rows[0]
         return old_dir_id
     else:
         if is_root:
@@ -235,14 +561,164 @@ def _update_dir_data(cursor, path, now):
         else:
             parent_path = os.path.dirname(path)
             parent_id = _update_dir_data(cursor, parent_path, now)
+        if len(rows) > 0:
+            dir_id = rows[0][0]
+            cursor.execute(
+                """
+                update dirs
+                set parent_id = ?,
+                    first_observed = ?,
+                    deleted_before = null,
+                    mtime = null,
+                    dirty = 1
+                where id = ?
+            """,
+                (parent_id, now, dir_id),
+            )
+        else:
+            cursor.execute(
+                """
+                insert into dirs (path, parent_id, first_observed, dirty)
+                values(?, ?, ?, 1)
+            """,
+                (path, parent_id, now),
+            )
+            dir_id = cursor.lastrowid
+        if parent_id is not None:
+            _mark_dir_changed(cursor, parent_id)
+        return dir_id
+
+
+def _mark_dir_changed(cursor, dir_id):
+    """Mark a directory and its ancestors as needing their summaries updated.
+
+    Ancestors of a dirty directory are always dirty, so this stops at the
+    first directory which is already dirty.
+
+    """
+    while dir_id is not None:
         cursor.execute(
             """
-            insert into dirs (path, parent_id, first_observed)
-            values(?, ?, ?)
+            update dirs
+            set dirty = 1
+            where id = ?
+            and dirty is not 1
+        """,
+            (dir_id,),
+        )
+        if cursor.rowcount == 0:
+            break
+        cursor.execute("select parent_id from dirs where id = ?", (dir_id,))
+        dir_id = cursor.fetchone()[0]
+
+
+def _record_change(cursor, path, old_hash, new_hash, event, now):
+    cursor.execute(
+        """
+        insert into changes (path, old_hash, new_hash, event, timestamp)
+        values(?, ?, ?, ?, ?)
+    """,
+        (path, old_hash, new_hash, event, now),
+    )
+
+
+def get_changes(connection, after_seq, limit=1000):
+    """Return a list of up to limit changes with sequence numbers after
+    after_seq.
+
+    Each change is a (seq, path, old_hash, new_hash, event, timestamp) tuple,
+    where event is one of "created", "modified" or "deleted".
+
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            select seq, path, old_hash, new_hash, event, timestamp
+            from changes
+            where seq > ?
+            order by seq
+            limit ?
+        """,
+            (after_seq, limit),
+        )
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def get_changed_file_records(connection, after_seq):
+    """Return an iterator over the paths changed after after_seq, sorted by
+    path, as (path, hash, filesize, mtime, first_observed, timestamp) tuples.
+
+    The hash, filesize, mtime and first_observed are those of the current
+    file at the path, or None if there isn't one.  timestamp is the time of
+    the last change to the path.
+
+    """
+    cursor = connection.cursor()
+    try:
+        # sqlite takes the timestamp from the row with the max(seq).
+        cursor.execute(
+            """
+            select changed.path, files.hash, files.filesize, files.mtime,
+                files.first_observed, changed.timestamp
+            from (
+                select path, max(seq), timestamp
+                from changes
+                where seq > ?
+                group by path
+            ) as changed
+            left join files
+                on files.path = changed.path
+                and files.deleted_before is null
+            order by changed.path
         """,
-            (path, parent_id, now),
+            (after_seq,),
         )
-        return cursor.lastrowid
+        while True:
+            items = cursor.fetchmany()
+            if len(items) == 0:
+                break
+            yield from items
+    finally:
+        cursor.close()
+
+
+def changes_expired(connection, after_seq):
+    """Return True if changes after after_seq have been pruned from the log."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute("select min(seq) from changes")
+        first_seq = cursor.fetchone()[0]
+        if first_seq is None:
+            # Sequence numbers are never reused, so the next one is one more
+            # than the last one handed out.
+            first_seq = get_last_change_seq(connection) + 1
+        return after_seq + 1 < first_seq
+    finally:
+        cursor.close()
+
+
+def get_last_change_seq(connection):
+    """Return the sequence number of the most recent change, or 0."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute("select seq from sqlite_sequence where name = 'changes'")
+        row = cursor.fetchone()
+        return row[0] if row else 0
+    finally:
+        cursor.close()
+
+
+def prune_changes(connection, before):
+    """Remove changes with timestamps before the given time from the log."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute("delete from changes where timestamp < ?", (before,))
+    finally:
+        cursor.close()
+
 
 def update_file_data(connection, new_hash, filesize, path, mtime, now):
     cursor = connection.cursor()
@@ -270,10 +746,15 @@ def update_file_data(connection, new_hash, filesize, path, mtime, now):
             cursor.execute(
                 """
                 replace into files (rowid, hash, filesize, path, mtime, first_observed, dir_id)
-                values(?, ?, ?, ?, ?, ?)
+                values(?, ?, ?, ?, ?, ?, ?)
             """,
                 (rowid, new_hash, filesize, path, mtime, old_first_observed, dir_id),
             )
+            _mark_dir_changed(cursor, dir_id)
+            if old_dir_id != dir_id:
+                _mark_dir_changed(cursor, old_dir_id)
+            if old_hash != new_hash:
+                _record_change(cursor, path, old_hash, new_hash, "modified", now)
         else:
             dir_path = os.path.dirname(path)
             dir_id = _update_dir_data(cursor, dir_path, now)
@@ -285,6 +766,8 @@ def update_file_data(connection, new_hash, filesize, path, mtime, now):
             """,
                 (new_hash, filesize, path, mtime, now, dir_id),
             )
+            _mark_dir_changed(cursor, dir_id)
+            _record_change(cursor, path, None, new_hash, "created", now)
     finally:
         cursor.close()
 
@@ -292,6 +775,18 @@ def update_file_data(connection, new_hash, filesize, path, mtime, now):
 def update_deleted_file_data(connection, path, now):
     cursor = connection.cursor()
     try:
+        cursor.execute(
+            """
+                select dir_id, hash
+                from files
+                where path = ?
+                and deleted_before is null
+            """,
+            (path,),
+        )
+        for dir_id, old_hash in cursor.fetchall():
+            _mark_dir_changed(cursor, dir_id)
+            _record_change(cursor, path, old_hash, None, "deleted", now)
         cursor.execute(
             """
                 update files
@@ -306,3 +801,627 @@ def update_deleted_file_data(connection, path, now):
         )
     finally:
         cursor.close()
+
+
+def _bump_counter(cursor, key):
+    cursor.execute(
+        """
+        insert or replace into meta (key, value)
+        values(?, coalesce((select value from meta where key = ?), 0) + 1)
+    """,
+        (key, key),
+    )
+
+
+def get_counter(connection, key):
+    cursor = connection.cursor()
+    try:
+        cursor.execute("select value from meta where key = ?", (key,))
+        row = cursor.fetchone()
+        if row is None:
+            return 0
+        return row[0]
+    finally:
+        cursor.close()
+
+
+def get_symlinks_version(connection):
+    """Return a number which changes whenever the stored symlinks change."""
+    return get_counter(connection, "symlinks_version")
+
+
+def get_current_symlinks(connection):
+    """Return an iterator over (path, target) for all current symlinks."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            select path, target
+            from symlinks
+            where deleted_before is null
+        """
+        )
+        while True:
+            items = cursor.fetchmany()
+            if len(items) == 0:
+                break
+            yield from items
+    finally:
+        cursor.close()
+
+
+def get_symlink_target(connection, path):
+    """Return the target of the current symlink at path, or None."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            select target
+            from symlinks indexed by idx_current_symlinks
+            where path = ?
+            and deleted_before is null
+        """,
+            (path,),
+        )
+        row = cursor.fetchone()
+        return None if row is None else row[0]
+    finally:
+        cursor.close()
+
+
+def update_symlink_data(connection, path, target, now):
+    """Record that a symlink exists with the given target.
+
+    Returns True if this changed the stored data.
+
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            select rowid, target
+            from symlinks
+            where path = ?
+            and deleted_before is null
+        """,
+            (path,),
+        )
+        rows = cursor.fetchall()
+        if len(rows) > 0:
+            assert len(rows) == 1
+            rowid, old_target = rows[0]
+            if old_target == target:
+                return False
+            cursor.execute(
+                """
+                update symlinks
+                set deleted_before = ?
+                where rowid = ?
+            """,
+                (now, rowid),
+            )
+
+        dir_id = _update_dir_data(cursor, os.path.dirname(path), now)
+        cursor.execute(
+            """
+            insert into symlinks (path, target, dir_id, first_observed)
+            values(?, ?, ?, ?)
+        """,
+            (path, target, dir_id, now),
+        )
+        _mark_dir_changed(cursor, dir_id)
+        _bump_counter(cursor, "symlinks_version")
+        return True
+    finally:
+        cursor.close()
+
+
+def update_deleted_symlink_data(connection, path, now):
+    """Record that a symlink no longer exists.
+
+    Returns True if this changed the stored data.
+
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+                select dir_id
+                from symlinks
+                where path = ?
+                and deleted_before is null
+            """,
+            (path,),
+        )
+        dir_ids = [row[0] for row in cursor.fetchall()]
+        if len(dir_ids) == 0:
+            return False
+        for dir_id in dir_ids:
+            _mark_dir_changed(cursor, dir_id)
+        cursor.execute(
+            """
+                update symlinks
+                set deleted_before = ?
+                where path = ?
+                and deleted_before is null
+            """,
+            (
+                now,
+                path,
+            ),
+        )
+        _bump_counter(cursor, "symlinks_version")
+        return True
+    finally:
+        cursor.close()
+
+
+def update_deleted_dir_data(connection, path, now):
+    """Record that a directory no longer exists.
+
+    Only the directory itself is marked deleted; its files, symlinks and
+    subdirectories should be deleted separately.  Returns True if this
+    changed the stored data.
+
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            select id, parent_id
+            from dirs
+            where path = ?
+            and deleted_before is null
+        """,
+            (path,),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return False
+        dir_id, parent_id = row
+        cursor.execute("update dirs set deleted_before = ? where id = ?", (now, dir_id))
+        if parent_id is not None:
+            _mark_dir_changed(cursor, parent_id)
+        return True
+    finally:
+        cursor.close()
+
+
+def _dir_summary(cursor, dir_id):
+    """Calculate the content hash, total size and file count of a directory.
+
+    The hash covers the names and hashes of the files and subdirectories
+    directly in the directory, and the names and targets of its symlinks, so
+    two directories have the same hash exactly when their whole subtrees
+    have the same names and contents.  Symlinks don't count towards the size
+    or file count.
+
+    """
+    cursor.execute(
+        """
+        select path, hash, filesize
+        from files
+        where dir_id = ?
+        and deleted_before is null
+    """,
+        (dir_id,),
+    )
+    entries = [
+        (os.path.basename(path), "f", content_hash, filesize or 0, 1)
+        for path, content_hash, filesize in cursor.fetchall()
+    ]
+    cursor.execute(
+        """
+        select path, content_hash, total_size, file_count
+        from dirs
+        where parent_id = ?
+        and deleted_before is null
+    """,
+        (dir_id,),
+    )
+    entries.extend(
+        (os.path.basename(path), "d", content_hash, total_size or 0, file_count or 0)
+        for path, content_hash, total_size, file_count in cursor.fetchall()
+    )
+    cursor.execute(
+        """
+        select path, target
+        from symlinks
+        where dir_id = ?
+        and deleted_before is null
+    """,
+        (dir_id,),
+    )
+    entries.extend(
+        (os.path.basename(path), "l", target, 0, 0)
+        for path, target in cursor.fetchall()
+    )
+    entries.sort()
+
+    h = hashlib.sha256()
+    total_size = 0
+    file_count = 0
+    for name, kind, content_hash, size, count in entries:
+        h.update("{}\0{}\0{}\0".format(kind, name, content_hash).encode("utf8"))
+        total_size += size
+        file_count += count
+    return h.hexdigest(), total_size, file_count
+
+
+def refresh_dir_summaries(connection, now):
+    """Update the summaries of all directories which have changed.
+
+    Directories are processed deepest first, so each directory's children
+    are up to date before it is summarised.
+
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            select id, content_hash, content_changed
+            from dirs
+            where dirty = 1
+            order by length(path) desc
+        """
+        )
+        for dir_id, old_hash, content_changed in cursor.fetchall():
+            content_hash, total_size, file_count = _dir_summary(cursor, dir_id)
+            cursor.execute(
+                """
+                update dirs
+                set content_hash = ?,
+                    total_size = ?,
+                    file_count = ?,
+                    content_changed = ?,
+                    dirty = null
+                where id = ?
+            """,
+                (
+                    content_hash,
+                    total_size,
+                    file_count,
+                    now if content_hash != old_hash else content_changed,
+                    dir_id,
+                ),
+            )
+    finally:
+        cursor.close()
+
+
+def get_dir_summary(connection, path):
+    """Return (content_hash, total_size, file_count, content_changed) for a
+    directory, or None if it's not a current directory.
+
+    content_changed is the time that the contents of anything in the
+    directory's subtree were last seen to change.
+
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            select content_hash, total_size, file_count, content_changed
+            from dirs
+            where path = ?
+            and deleted_before is null
+        """,
+            (path,),
+        )
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+
+
+def _dir_children(cursor, path):
+    """Return a dict mapping child names to (kind, hash) for a directory."""
+    cursor.execute(
+        "select id from dirs where path = ? and deleted_before is null", (path,)
+    )
+    row = cursor.fetchone()
+    if row is None:
+        return {}
+    dir_id = row[0]
+    cursor.execute(
+        """
+        select path, hash
+        from files
+        where dir_id = ?
+        and deleted_before is null
+    """,
+        (dir_id,),
+    )
+    children = {
+        os.path.basename(child): ("f", content_hash)
+        for child, content_hash in cursor.fetchall()
+    }
+    cursor.execute(
+        """
+        select path, content_hash
+        from dirs
+        where parent_id = ?
+        and deleted_before is null
+    """,
+        (dir_id,),
+    )
+    children.update(
+        (os.path.basename(child), ("d", content_hash))
+        for child, content_hash in cursor.fetchall()
+    )
+    cursor.execute(
+        """
+        select path, target
+        from symlinks
+        where dir_id = ?
+        and deleted_before is null
+    """,
+        (dir_id,),
+    )
+    children.update(
+        (os.path.basename(child), ("l", target)) for child, target in cursor.fetchall()
+    )
+    return children
+
+
+def diff_dirs(connection, path_a, path_b):
+    """Compare two directory trees using their content hashes.
+
+    Returns an iterator over (relative path, change) tuples, where change is
+    one of "added", "removed" or "changed".  Only subdirectories whose hashes
+    differ are descended into.
+
+    """
+    cursor = connection.cursor()
+    try:
+        pending = [""]
+        while pending:
+            relpath = pending.pop()
+            children_a = _dir_children(
+                cursor, os.path.normpath(os.path.join(path_a, relpath))
+            )
+            children_b = _dir_children(
+                cursor, os.path.normpath(os.path.join(path_b, relpath))
+            )
+            for name in sorted(set(children_a) | set(children_b)):
+                child = os.path.join(relpath, name)
+                a = children_a.get(name)
+                b = children_b.get(name)
+                if a is None:
+                    yield child, "added"
+                elif b is None:
+                    yield child, "removed"
+                elif a != b:
+                    if a[0] == "d" and b[0] == "d":
+                        pending.append(child)
+                    else:
+                        yield child, "changed"
+    finally:
+        cursor.close()
+
+
+def get_duplicate_dirs(connection, min_size=0):
+    """Return an iterator over lists of paths of directories with identical
+    contents.
+
+    Directories with a total size below min_size are ignored.
+
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            select content_hash, path
+            from dirs indexed by idx_dir_content_hashes
+            where deleted_before is null
+            and content_hash is not null
+            and total_size >= ?
+            order by content_hash, path
+        """,
+            (min_size,),
+        )
+        group_hash = None
+        group = []
+        while True:
+            items = cursor.fetchmany()
+            if len(items) == 0:
+                break
+            for content_hash, path in items:
+                if content_hash != group_hash:
+                    if len(group) > 1:
+                        yield group
+                    group_hash = content_hash
+                    group = []
+                group.append(path)
+        if len(group) > 1:
+            yield group
+    finally:
+        cursor.close()
+
+
+def record_dir_mtime(connection, path, mtime, now):
+    """Record the modification time of a directory when it was listed."""
+    cursor = connection.cursor()
+    try:
+        dir_id = _update_dir_data(cursor, path, now)
+        cursor.execute("update dirs set mtime = ? where id = ?", (mtime, dir_id))
+    finally:
+        cursor.close()
+
+
+def get_dirs_page(connection, after="", limit=1000):
+    """Return a list of up to limit (path, mtime) tuples for current dirs with
+    paths sorted after the given path.
+
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            select path, mtime
+            from dirs
+            where path > ?
+            and deleted_before is null
+            order by path
+            limit ?
+        """,
+            (after, limit),
+        )
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def get_current_paths_in_dir(connection, path):
+    """Return the paths of all current files and symlinks directly in a dir."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            select files.path
+            from files
+            join dirs on files.dir_id = dirs.id
+            where dirs.path = ?
+            and dirs.deleted_before is null
+            and files.deleted_before is null
+            union
+            select symlinks.path
+            from symlinks
+            join dirs on symlinks.dir_id = dirs.id
+            where dirs.path = ?
+            and dirs.deleted_before is null
+            and symlinks.deleted_before is null
+        """,
+            (path, path),
+        )
+        return [row[0] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def get_file_info(connection, path):
+    """Return (hash, filesize, mtime) for a current file, or None."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            select hash, filesize, mtime
+            from files
+            where path = ?
+            and deleted_before is null
+        """,
+            (path,),
+        )
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+
+
+def get_dir_info(connection, path):
+    """Return (total_size, mtime) for a current directory, or None."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            select total_size, mtime
+            from dirs
+            where path = ?
+            and deleted_before is null
+        """,
+            (path,),
+        )
+        return cursor.fetchone()
+    finally:
+        cursor.close()
+
+
+def get_dir_entries(connection, path):
+    """Return the current contents of a directory, sorted by name.
+
+    Each entry is a (name, is_dir, size, mtime) tuple.  The size of a
+    directory is the total size of the files under it.
+
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            "select id from dirs where path = ? and deleted_before is null", (path,)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return []
+        dir_id = row[0]
+        cursor.execute(
+            """
+            select path, 1, total_size, mtime
+            from dirs
+            where parent_id = ?
+            and deleted_before is null
+            union all
+            select path, 0, filesize, mtime
+            from files
+            where dir_id = ?
+            and deleted_before is null
+        """,
+            (dir_id, dir_id),
+        )
+        entries = [
+            (os.path.basename(child), bool(is_dir), size or 0, mtime or 0)
+            for child, is_dir, size, mtime in cursor.fetchall()
+        ]
+        entries.sort()
+        return entries
+    finally:
+        cursor.close()
+
+
+def get_hash_locations(connection, content_hash):
+    """Return a list of (path, filesize, mtime) for current files with a hash."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            select path, filesize, mtime
+            from files indexed by idx_current_file_hashes
+            where hash = ?
+            and deleted_before is null
+            order by path
+        """,
+            (content_hash,),
+        )
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def get_hashes_page(connection, after="", limit=1000):
+    """Return a list of up to limit (hash, filesize, mtime) tuples for the
+    distinct current hashes sorted after the given hash.
+
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            select hash, max(filesize), max(mtime)
+            from files indexed by idx_current_file_hashes
+            where hash > ?
+            and deleted_before is null
+            group by hash
+            order by hash
+            limit ?
+        """,
+            (after, limit),
+        )
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def get_data_version(connection):
+    """Return a number which changes when other connections commit changes."""
+    cursor = connection.cursor()
+    try:
+        cursor.execute("pragma data_version")
+        return cursor.fetchone()[0]
+    finally:
+        cursor.close()
@@ -22,3 +22,239 @@ def test_connect():
         db.init_schema(conn_ro)
 
     db.init_schema(conn)
+
+
+def test_update_file_data(conn):
+    db.update_file_data(conn, "h1", 10, "/a/f", 100, 1)
+    db.update_file_data(conn, "h2", 20, "/a/f", 200, 2)
+    assert db.get_current_file_data(conn, ["/a/f"]) == [("h2", "/a/f", 200)]
+    db.update_deleted_file_data(conn, "/a/f", 3)
+    assert db.get_current_file_data(conn, ["/a/f"]) == []
+
+
+def test_dir_summaries(conn):
+    db.update_file_data(conn, "h1", 10, "/r/a/x/f1", 100, 1)
+    db.update_file_data(conn, "h2", 20, "/r/a/f2", 100, 1)
+    db.update_file_data(conn, "h1", 10, "/r/b/x/f1", 100, 1)
+    db.update_file_data(conn, "h2", 20, "/r/b/f2", 100, 1)
+    db.refresh_dir_summaries(conn, 1)
+
+    hash_a, size, count, changed = db.get_dir_summary(conn, "/r/a")
+    assert (size, count, changed) == (30, 2, 1)
+    assert db.get_dir_summary(conn, "/r/b")[0] == hash_a
+    assert db.get_dir_summary(conn, "/r")[1:3] == (60, 4)
+    assert sorted(db.get_duplicate_dirs(conn)) == [
+        ["/r/a", "/r/b"],
+        ["/r/a/x", "/r/b/x"],
+    ]
+    assert list(db.get_duplicate_dirs(conn, min_size=25)) == [["/r/a", "/r/b"]]
+    assert list(db.diff_dirs(conn, "/r/a", "/r/b")) == []
+
+    # Changes propagate up to the root
+    root_hash = db.get_dir_summary(conn, "/")[0]
+    db.update_file_data(conn, "h3", 5, "/r/b/x/f1", 200, 2)
+    db.update_file_data(conn, "h4", 5, "/r/b/x/new", 200, 2)
+    db.update_deleted_file_data(conn, "/r/b/f2", 2)
+    db.refresh_dir_summaries(conn, 2)
+    assert db.get_dir_summary(conn, "/r/b")[1:] == (10, 2, 2)
+    assert db.get_dir_summary(conn, "/r/a")[3] == 1
+    assert db.get_dir_summary(conn, "/")[0] != root_hash
+    assert db.get_dir_summary(conn, "/")[3] == 2
+    assert list(db.get_duplicate_dirs(conn)) == []
+    assert list(db.diff_dirs(conn, "/r/a", "/r/b")) == [
+        ("f2", "removed"),
+        ("x/f1", "changed"),
+        ("x/new", "added"),
+    ]
+
+
+def test_dir_summaries_include_symlinks(conn):
+    for name in ("a", "b"):
+        db.update_file_data(conn, "h1", 10, "/r/{}/f".format(name), 100, 1)
+        db.update_symlink_data(conn, "/r/{}/link".format(name), "f", 1)
+    db.refresh_dir_summaries(conn, 1)
+    hash_a, size, count, _ = db.get_dir_summary(conn, "/r/a")
+    assert (size, count) == (10, 1)
+    assert db.get_dir_summary(conn, "/r/b")[0] == hash_a
+
+    db.update_symlink_data(conn, "/r/b/link", "other", 2)
+    db.refresh_dir_summaries(conn, 2)
+    assert db.get_dir_summary(conn, "/r/b")[0] != hash_a
+    assert list(db.diff_dirs(conn, "/r/a", "/r/b")) == [("link", "changed")]
+
+    db.update_deleted_symlink_data(conn, "/r/b/link", 3)
+    db.refresh_dir_summaries(conn, 3)
+    assert list(db.diff_dirs(conn, "/r/a", "/r/b")) == [("link", "removed")]
+    assert list(db.get_duplicate_dirs(conn)) == []
+
+
+def test_dir_summaries_recalculated_after_upgrade(conn):
+    db.record_dir_mtime(conn, "/r", 1, 1)
+    db.refresh_dir_summaries(conn, 1)
+    conn.execute("update meta set value = 1 where key = 'dir_summary_version'")
+    db.init_schema(conn)
+    assert conn.execute("select count(*) from dirs where dirty = 1").fetchone() == (2,)
+    assert db.get_counter(conn, "dir_summary_version") == db.DIR_SUMMARY_VERSION
+
+
+def test_add_missing_columns(tmp_path):
+    conn = db.connect(test_config._replace(db_dir=str(tmp_path)), read_only=False)
+    conn.execute(
+        """
+        create table dirs (
+          id integer primary key autoincrement,
+          path text unique,
+          parent_id integer,
+          first_observed integer,
+          deleted_before integer
+        )
+    """
+    )
+    conn.execute("insert into dirs (path, first_observed) values ('/', 1)")
+    db.init_schema(conn)
+    db.refresh_dir_summaries(conn, 2)
+    assert db.get_dir_summary(conn, "/")[1:] == (0, 0, 2)
+    conn.close()
+
+
+def test_get_duplicate_files(conn):
+    db.update_file_data(conn, "h1", 10, "/r/a/f1", 100, 1)
+    db.update_file_data(conn, "h1", 10, "/r/b/f1", 100, 1)
+    db.update_file_data(conn, "h1", 10, "/other/f1", 100, 1)
+    db.update_file_data(conn, "h2", 1000, "/r/a/big", 100, 1)
+    db.update_file_data(conn, "h2", 1000, "/r/b/big", 100, 1)
+    db.update_file_data(conn, "h3", 5, "/r/a/unique", 100, 1)
+    db.update_file_data(conn, "h4", 5, "/r/a/gone", 100, 1)
+    db.update_file_data(conn, "h4", 5, "/r/b/gone", 100, 1)
+    db.update_deleted_file_data(conn, "/r/b/gone", 2)
+
+    assert list(db.get_duplicate_files(conn)) == [
+        ("h1", 10, ["/other/f1", "/r/a/f1", "/r/b/f1"], 20),
+        ("h2", 1000, ["/r/a/big", "/r/b/big"], 1000),
+    ]
+    assert list(db.get_duplicate_files(conn, min_size=100)) == [
+        ("h2", 1000, ["/r/a/big", "/r/b/big"], 1000),
+    ]
+    assert list(db.get_duplicate_files(conn, prefixes=["/r/a/", "/other"])) == [
+        ("h1", 10, ["/other/f1", "/r/a/f1"], 10),
+    ]
+
+
+def test_dir_mtimes(conn):
+    db.update_file_data(conn, "h1", 10, "/r/a/f1", 100, 1)
+    db.update_symlink_data(conn, "/r/a/link", "f1", 1)
+    db.update_file_data(conn, "h2", 10, "/r/b/f2", 100, 1)
+    db.record_dir_mtime(conn, "/r/a", 50, 1)
+    db.record_dir_mtime(conn, "/r/empty", 60, 1)
+
+    assert db.get_dirs_page(conn, limit=3) == [("/", None), ("/r", None), ("/r/a", 50)]
+    assert db.get_dirs_page(conn, "/r/a") == [("/r/b", None), ("/r/empty", 60)]
+    assert sorted(db.get_current_paths_in_dir(conn, "/r/a")) == [
+        "/r/a/f1",
+        "/r/a/link",
+    ]
+    assert db.get_current_paths_in_dir(conn, "/r/empty") == []
+
+
+def test_deleted_dirs(conn):
+    db.record_dir_mtime(conn, "/r/a", 50, 1)
+    db.refresh_dir_summaries(conn, 1)
+    assert db.update_deleted_dir_data(conn, "/r/a", 2)
+    assert not db.update_deleted_dir_data(conn, "/r/a", 3)
+    assert db.get_dirs_page(conn) == [("/", None), ("/r", None)]
+    assert conn.execute("select dirty from dirs where path = '/r'").fetchone() == (1,)
+
+    # A directory which reappears gets its old record back.
+    db.update_file_data(conn, "h1", 10, "/r/a/f1", 100, 4)
+    assert db.get_dirs_page(conn, "/r") == [("/r/a", None)]
+    assert db.get_current_paths_in_dir(conn, "/r/a") == ["/r/a/f1"]
+
+
+def test_changes(conn):
+    db.update_file_data(conn, "h1", 10, "/a/f", 100, 1)
+    db.update_file_data(conn, "h1", 10, "/a/f", 200, 2)
+    db.update_file_data(conn, "h2", 10, "/a/f", 300, 3)
+    db.update_deleted_file_data(conn, "/a/f", 4)
+    db.update_deleted_file_data(conn, "/a/f", 5)
+    assert db.get_changes(conn, 0) == [
+        (1, "/a/f", None, "h1", "created", 1),
+        (2, "/a/f", "h1", "h2", "modified", 3),
+        (3, "/a/f", "h2", None, "deleted", 4),
+    ]
+    assert db.get_changes(conn, 1, limit=1) == [
+        (2, "/a/f", "h1", "h2", "modified", 3),
+    ]
+
+    assert not db.changes_expired(conn, 0)
+    db.prune_changes(conn, 3)
+    assert db.changes_expired(conn, 0)
+    assert not db.changes_expired(conn, 1)
+    db.prune_changes(conn, 10)
+    assert db.get_changes(conn, 0) == []
+    assert db.changes_expired(conn, 2)
+    assert not db.changes_expired(conn, 3)
+
+
+def test_changed_file_records(conn):
+    db.update_file_data(conn, "h1", 10, "/a/f", 100, 1)
+    db.update_file_data(conn, "h2", 10, "/a/g", 100, 2)
+    db.update_file_data(conn, "h3", 10, "/a/f", 200, 3)
+    db.update_deleted_file_data(conn, "/a/g", 4)
+    assert list(db.get_changed_file_records(conn, 1)) == [
+        ("/a/f", "h3", 10, 200, 1, 3),
+        ("/a/g", None, None, None, None, 4),
+    ]
+    assert list(db.get_changed_file_records(conn, 4)) == []
+
+
+def test_batches():
+    assert list(db.batches(range(5), 2)) == [[0, 1], [2, 3], [4]]
+
+
+def test_fs_queries(conn):
+    db.update_file_data(conn, "h1", 10, "/r/a/f1", 100, 1)
+    db.update_file_data(conn, "h1", 10, "/r/f1", 200, 1)
+    db.update_file_data(conn, "h2", 20, "/r/f2", 300, 1)
+    db.record_dir_mtime(conn, "/r/a", 50, 1)
+    db.refresh_dir_summaries(conn, 1)
+
+    assert db.get_file_info(conn, "/r/f2") == ("h2", 20, 300)
+    assert db.get_file_info(conn, "/r/a") is None
+    assert db.get_dir_info(conn, "/r/a") == (10, 50)
+    assert db.get_dir_entries(conn, "/r") == [
+        ("a", True, 10, 50),
+        ("f1", False, 10, 200),
+        ("f2", False, 20, 300),
+    ]
+    assert db.get_dir_entries(conn, "/missing") == []
+    assert db.get_hash_locations(conn, "h1") == [
+        ("/r/a/f1", 10, 100),
+        ("/r/f1", 10, 200),
+    ]
+    assert db.get_hashes_page(conn) == [("h1", 10, 200), ("h2", 20, 300)]
+    assert db.get_hashes_page(conn, "h1") == [("h2", 20, 300)]
+    assert db.get_hashes_page(conn, limit=1) == [("h1", 10, 200)]
+    assert isinstance(db.get_data_version(conn), int)
+
+
+def test_crawl_progress(conn):
+    assert not db.crawl_in_progress(conn)
+    assert db.get_crawl_frontier(conn, "/r") is None
+    db.save_crawl_frontier(conn, "/r", ["/r/a", "/r/b"], 1)
+    db.save_crawl_frontier(conn, "/s", [], 1)
+    assert db.crawl_in_progress(conn)
+    assert db.get_crawl_frontier(conn, "/r") == ["/r/a", "/r/b"]
+    assert db.get_crawl_frontier(conn, "/s") == []
+    db.clear_crawl_progress(conn)
+    assert not db.crawl_in_progress(conn)
+
+
+def test_clear_visits_under_root(conn):
+    for path in ("/r", "/r/a", "/r-x/a", "/r0", "/s/a"):
+        db.record_visit(conn, path)
+    db.clear_visits(conn, "/r")
+    assert sorted(row[0] for row in conn.execute("select path from visits")) == [
+        "/r-x/a",
+        "/r0",
+        "/s/a",
+    ]
@@ -0,0 +1,590 @@
+"""Merging the indexes of several hosts.
+
+Each host exports its index with export(), and the exports are merged into
+an aggregate database with merge_export(), which records the host of each
+path.  The aggregate can then be asked where content is stored across all
+the hosts.
+
+Exports are gzipped files of JSON lines.  The first line is a header:
+
+    {"format": "filer-export", "version": 1, "host": ..., "since": ...,
+     "seq": ..., "history": ..., "exported": ...}
+
+seq is the sequence number of the last change in the host's change log
+covered by the export.  A full export has a since of null, and holds every
+current file (and with history, every deleted file too).  An incremental
+export holds the current state of just the paths changed after since, and
+can only be merged into an aggregate which already has the host's changes
+up to since.  The other lines are files, with short keys to keep exports
+compact:
+
+    {"p": path, "h": hash, "s": size, "m": mtime, "f": first_observed}
+    {"p": path, "h": ..., "s": ..., "m": ..., "f": ..., "d": deleted_before}
+    {"p": path, "d": deleted_before}
+
+The last form is a path deleted after since.  Changes which leave a file's
+hash the same aren't in the change log, so incremental exports don't update
+the mtimes of files which were only touched.
+
+"""
+
+import argparse
+import gzip
+import json
+import socket
+import sqlite3
+import sys
+import time
+
+from . import config
+from . import db
+
+FORMAT = "filer-export"
+VERSION = 1
+LOOKUP_BATCH_SIZE = 10000
+
+
+def _file_entry(record):
+    path, content_hash, filesize, mtime, first_observed, deleted_before = record
+    entry = {
+        "p": path,
+        "h": content_hash,
+        "s": filesize,
+        "m": mtime,
+        "f": first_observed,
+    }
+    if deleted_before is not None:
+        entry["d"] = deleted_before
+    return entry
+
+
+def _changed_entries(connection, since):
+    for record in db.get_changed_file_records(connection, since):
+        path, content_hash, filesize, mtime, first_observed, timestamp = record
+        if content_hash is None:
+            yield {"p": path, "d": timestamp}
+        else:
+            yield _file_entry(
+                (path, content_hash, filesize, mtime, first_observed, None)
+            )
+
+
+def _write_line(fobj, item):
+    fobj.write(json.dumps(item, separators=(",", ":")) + "\n")
+
+
+def export(connection, fobj, host=None, since=None, history=False, now=None):
+    """Write an export of a filer database to a binary file object.
+
+    Exports everything if since is None, otherwise just the changes after
+    that sequence number.  history only applies to full exports.  Returns
+    the header written.  Raises ValueError if the changes after since have
+    been pruned from the change log.
+
+    """
+    if host is None:
+        host = socket.gethostname()
+    if now is None:
+        now = int(time.time())
+
+    # Read everything in one transaction, so seq matches the files exported.
+    connection.execute("begin")
+    try:
+        if since is not None and db.changes_expired(connection, since):
+            raise ValueError(
+                "Changes after {} have been pruned - a full export is needed".format(
+                    since
+                )
+            )
+        header = {
+            "format": FORMAT,
+            "version": VERSION,
+            "host": host,
+            "since": since,
+            "seq": db.get_last_change_seq(connection),
+            "history": history and since is None,
+            "exported": now,
+        }
+        with gzip.open(fobj, "wt", encoding="utf8") as out:
+            _write_line(out, header)
+            if since is None:
+                records = db.get_file_records(connection, None, history)
+                entries = map(_file_entry, records)
+            else:
+                entries = _changed_entries(connection, since)
+            for entry in entries:
+                _write_line(out, entry)
+    finally:
+        connection.rollback()
+    return header
+
+
+def connect_aggregate(path):
+    """Open (creating if needed) an aggregate database."""
+    connection = sqlite3.connect(path)
+    init_aggregate_schema(connection)
+    return connection
+
+
+def init_aggregate_schema(connection):
+    cursor = connection.cursor()
+    for sql in (
+        """
+        pragma journal_mode=WAL;
+        """,
+        """
+        create table if not exists hosts (
+          id integer primary key autoincrement,
+          name text unique,
+          seq integer,
+          exported integer
+        );
+        """,
+        """
+        create table if not exists entries (
+          host_id integer,
+          path text,
+          hash text,
+          filesize integer,
+          mtime integer,
+          first_observed integer,
+          deleted_before integer,
+          foreign key(host_id) references hosts(id)
+        );
+        """,
+        """
+        create index if not exists idx_current_entry_hashes on entries (
+          hash,
+          filesize,
+          host_id,
+          path
+        ) where deleted_before is null;
+    """,
+        """
+        create index if not exists idx_current_entry_paths on entries (
+          host_id,
+          path
+        ) where deleted_before is null;
+    """,
+        """
+        create index if not exists idx_entry_hashes on entries (
+          hash
+        );
+    """,
+    ):
+        cursor.execute(sql)
+
+    cursor.close()
+    connection.commit()
+
+
+def _read_header(line):
+    try:
+        header = json.loads(line or "null")
+    except ValueError:
+        header = None
+    if not isinstance(header, dict) or header.get("format") != FORMAT:
+        raise ValueError("Not a filer export")
+    if header.get("version") != VERSION:
+        raise ValueError("Unsupported export version {}".format(header.get("version")))
+    return header
+
+
+def _insert_entry(cursor, host_id, entry):
+    cursor.execute(
+        """
+        insert into entries
+        (host_id, path, hash, filesize, mtime, first_observed, deleted_before)
+        values(?, ?, ?, ?, ?, ?, ?)
+    """,
+        (
+            host_id,
+            entry["p"],
+            entry["h"],
+            entry["s"],
+            entry["m"],
+            entry["f"],
+            entry.get("d"),
+        ),
+    )
+
+
+def _merge_change(cursor, host_id, entry, now):
+    cursor.execute(
+        """
+        select rowid, hash
+        from entries
+        where host_id = ?
+        and path = ?
+        and deleted_before is null
+    """,
+        (host_id, entry["p"]),
+    )
+    row = cursor.fetchone()
+    if "h" not in entry:
+        deleted_before = entry["d"]
+    elif row is not None and row[1] == entry["h"]:
+        cursor.execute(
+            "update entries set filesize = ?, mtime = ? where rowid = ?",
+            (entry["s"], entry["m"], row[0]),
+        )
+        return
+    else:
+        deleted_before = now
+        _insert_entry(cursor, host_id, entry)
+    if row is not None:
+        cursor.execute(
+            "update entries set deleted_before = ? where rowid = ?",
+            (deleted_before, row[0]),
+        )
+
+
+def merge_export(connection, fobj, force=False):
+    """Merge an export, read from a binary file object, into an aggregate.
+
+    A full export replaces the host's current files (and, if it has
+    history, its deleted files too).  An incremental export updates the
+    paths in it, keeping replaced and deleted files as history.  Returns
+    (header, number of entries merged).  Raises ValueError if the export
+    can't be merged, leaving the aggregate unchanged.
+
+    A full export older than the changes already merged from its host is
+    refused unless force is True, as it would roll the host back.  Forcing
+    is needed if the host's index was recreated, restarting its sequence
+    numbers.
+
+    """
+    with gzip.open(fobj, "rt", encoding="utf8") as lines:
+        header = _read_header(next(lines, None))
+        name = header["host"]
+        since = header["since"]
+        cursor = connection.cursor()
+        try:
+            cursor.execute("select id, seq from hosts where name = ?", (name,))
+            row = cursor.fetchone()
+            if since is not None:
+                if row is None:
+                    raise ValueError(
+                        "Incremental export from {}, which has no full export "
+                        "merged".format(name)
+                    )
+                if since > row[1]:
+                    raise ValueError(
+                        "Export from {} starts after change {}, but only "
+                        "changes up to {} have been merged".format(name, since, row[1])
+                    )
+                if header["seq"] < row[1]:
+                    raise ValueError(
+                        "Export from {} is older than the changes already "
+                        "merged".format(name)
+                    )
+            elif row is not None and header["seq"] < row[1] and not force:
+                raise ValueError(
+                    "Full export from {} is up to change {}, but changes up to "
+                    "{} have already been merged".format(name, header["seq"], row[1])
+                )
+
+            if row is None:
+                cursor.execute("insert into hosts (name) values(?)", (name,))
+                host_id = cursor.lastrowid
+            else:
+                host_id = row[0]
+
+            if since is None:
+                sql = "delete from entries where host_id = ?"
+                if not header["history"]:
+                    sql += " and deleted_before is null"
+                cursor.execute(sql, (host_id,))
+
+            count = 0
+            for line in lines:
+                entry = json.loads(line)
+                if since is None:
+                    _insert_entry(cursor, host_id, entry)
+                else:
+                    _merge_change(cursor, host_id, entry, header["exported"])
+                count += 1
+
+            cursor.execute(
+                "update hosts set seq = ?, exported = ? where id = ?",
+                (header["seq"], header["exported"], host_id),
+            )
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+    return header, count
+
+
+def get_hosts(connection):
+    """Return a list of (name, seq, exported) for the hosts merged.
+
+    seq is the value of since to use for the host's next incremental export.
+
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute("select name, seq, exported from hosts order by name")
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+
+def lookup_hashes(connection, hashes):
+    """Return a dict mapping each of hashes which is found to a list of the
+    (host, path) of the current files with that hash.
+
+    The hashes are looked up in batches, joining against a temporary table,
+    so any number can be passed in one call.  The cross join makes sqlite
+    search the hash index for each hash, rather than scanning the index to
+    avoid sorting the results.
+
+    """
+    results = {}
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            create temp table if not exists lookup_hashes (
+              hash text primary key
+            ) without rowid
+        """
+        )
+        for batch in db.batches(hashes, LOOKUP_BATCH_SIZE):
+            cursor.execute("delete from lookup_hashes")
+            cursor.executemany(
+                "insert or ignore into lookup_hashes (hash) values(?)",
+                ((content_hash,) for content_hash in batch),
+            )
+            cursor.execute(
+                """
+                select entries.hash, hosts.name, entries.path
+                from lookup_hashes
+                cross join entries on entries.hash = lookup_hashes.hash
+                join hosts on hosts.id = entries.host_id
+                where entries.deleted_before is null
+                order by entries.hash, hosts.name, entries.path
+            """
+            )
+            for content_hash, host, path in cursor.fetchall():
+                results.setdefault(content_hash, []).append((host, path))
+        cursor.execute("delete from lookup_hashes")
+        connection.commit()
+    finally:
+        cursor.close()
+    return results
+
+
+def where_else(connection, host, path):
+    """Return (hash, locations) for the current file at path on host, where
+    locations is a list of the (host, path) of the other copies of it.
+
+    Returns None if the file isn't known.
+
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            select entries.hash
+            from entries
+            join hosts on hosts.id = entries.host_id
+            where hosts.name = ?
+            and entries.path = ?
+            and entries.deleted_before is null
+        """,
+            (host, path),
+        )
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+    if row is None:
+        return None
+    locations = lookup_hashes(connection, [row[0]]).get(row[0], [])
+    return row[0], [location for location in locations if location != (host, path)]
+
+
+def get_cross_host_duplicates(connection, min_size=0):
+    """Return an iterator over groups of current files with identical
+    contents on more than one host.
+
+    Each group is a (hash, filesize, locations) tuple, where locations is a
+    list of (host, path).
+
+    """
+    cursor = connection.cursor()
+    try:
+        cursor.execute(
+            """
+            select entries.hash, entries.filesize, hosts.name, entries.path
+            from entries
+            join hosts on hosts.id = entries.host_id
+            where entries.deleted_before is null
+            and entries.filesize >= ?
+            order by entries.hash
+        """,
+            (min_size,),
+        )
+        group_hash = None
+        group_size = None
+        group = []
+        while True:
+            items = cursor.fetchmany()
+            if len(items) == 0:
+                break
+            for content_hash, filesize, host, path in items:
+                if content_hash != group_hash:
+                    if len(set(host for host, _ in group)) > 1:
+                        yield group_hash, group_size, group
+                    group_hash = content_hash
+                    group_size = filesize
+                    group = []
+                group.append((host, path))
+        if len(set(host for host, _ in group)) > 1:
+            yield group_hash, group_size, group
+    finally:
+        cursor.close()
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Export indexes, and merge and query them across hosts."
+    )
+    parser.add_argument("items", nargs="*", help="Hashes to look up")
+    parser.add_argument(
+        "--export", metavar="FILE", help="Export this host's index to FILE"
+    )
+    parser.add_argument(
+        "--since",
+        type=int,
+        metavar="SEQ",
+        help="Only export changes after sequence number SEQ",
+    )
+    parser.add_argument(
+        "--history",
+        action="store_true",
+        help="Include deleted files in a full export",
+    )
+    parser.add_argument(
+        "--host", help="Host name to record in the export (default: hostname)"
+    )
+    parser.add_argument(
+        "--db-dir", help="Database directory to export, instead of reading config"
+    )
+    parser.add_argument(
+        "--aggregate", metavar="DB", help="Aggregate database to merge into or query"
+    )
+    parser.add_argument(
+        "--merge",
+        action="append",
+        metavar="FILE",
+        help="Merge an export into the aggregate (may be repeated)",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Merge full exports even if they're older than those already merged",
+    )
+    parser.add_argument(
+        "--hosts", action="store_true", help="List the hosts in the aggregate"
+    )
+    parser.add_argument(
+        "--stdin",
+        action="store_true",
+        help="Read hashes to look up from stdin, one per line",
+    )
+    parser.add_argument(
+        "--where-else",
+        nargs=2,
+        metavar=("HOST", "PATH"),
+        help="List the other copies of a file",
+    )
+    parser.add_argument(
+        "--duplicates",
+        action="store_true",
+        help="List files with identical contents on more than one host",
+    )
+    parser.add_argument(
+        "--min-size",
+        type=int,
+        default=1,
+        help="Ignore files smaller than this when listing duplicates",
+    )
+    args = parser.parse_args(argv)
+
+    if args.export:
+        if args.db_dir:
+            export_config = config.load_config_from_data({"db": {"dir": args.db_dir}})
+        else:
+            export_config = config.get_config()
+            if export_config is None:
+                return 1
+        conn = db.connect(export_config)
+        try:
+            with open(args.export, "wb") as fobj:
+                header = export(conn, fobj, args.host, args.since, args.history)
+        finally:
+            conn.close()
+        print(json.dumps(header), file=sys.stderr)
+        return 0
+
+    if not args.aggregate:
+        parser.error("--aggregate is needed unless exporting")
+
+    conn = connect_aggregate(args.aggregate)
+    try:
+        for path in args.merge or ():
+            with open(path, "rb") as fobj:
+                try:
+                    header, count = merge_export(conn, fobj, args.force)
+                except ValueError as e:
+                    print("Unable to merge {}: {}".format(path, e), file=sys.stderr)
+                    return 1
+            print(
+                "Merged {} entries from {} up to change {}".format(
+                    count, header["host"], header["seq"]
+                ),
+                file=sys.stderr,
+            )
+
+        if args.hosts:
+            for name, seq, exported in get_hosts(conn):
+                print(json.dumps({"host": name, "seq": seq, "exported": exported}))
+
+        if args.where_else:
+            found = where_else(conn, *args.where_else)
+            if found is not None:
+                content_hash, locations = found
+                print(json.dumps({"hash": content_hash, "locations": locations}))
+
+        if args.duplicates:
+            for content_hash, filesize, locations in get_cross_host_duplicates(
+                conn, args.min_size
+            ):
+                print(
+                    json.dumps(
+                        {"hash": content_hash, "size": filesize, "locations": locations}
+                    )
+                )
+
+        hashes = args.items
+        if args.stdin:
+            # Read lazily, so long lists are looked up as they arrive.
+            hashes = (line.strip() for line in sys.stdin if line.strip())
+        for batch in db.batches(hashes, LOOKUP_BATCH_SIZE):
+            found = lookup_hashes(conn, batch)
+            for content_hash in batch:
+                print(
+                    json.dumps(
+                        {"hash": content_hash, "locations": found.get(content_hash, [])}
+                    )
+                )
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
@@ -0,0 +1,120 @@
+from . import db
+from . import federate
+import io
+import pytest
+
+
+def make_host_db(make_conn, name, files):
+    conn = make_conn(name)
+    for path, content_hash in files.items():
+        db.update_file_data(conn, content_hash, 10, path, 100, 1)
+    conn.commit()
+    return conn
+
+
+def export_to_bytes(conn, host, since=None, history=False):
+    fobj = io.BytesIO()
+    header = federate.export(conn, fobj, host, since, history, now=50)
+    return header, fobj.getvalue()
+
+
+def merge(aggregate, data):
+    return federate.merge_export(aggregate, io.BytesIO(data))
+
+
+@pytest.fixture
+def aggregate(tmp_path):
+    conn = federate.connect_aggregate(str(tmp_path / "aggregate.sqlite"))
+    yield conn
+    conn.close()
+
+
+def test_merge_and_lookup(make_conn, aggregate):
+    host_a = make_host_db(make_conn, "a", {"/x/1": "h1", "/x/2": "h2"})
+    host_b = make_host_db(make_conn, "b", {"/y/1": "h1", "/y/3": "h3"})
+    for name, conn in (("a", host_a), ("b", host_b)):
+        header, data = export_to_bytes(conn, name)
+        assert header["since"] is None
+        assert merge(aggregate, data) == (header, 2)
+
+    assert federate.lookup_hashes(aggregate, ["h1", "h2", "h4"]) == {
+        "h1": [("a", "/x/1"), ("b", "/y/1")],
+        "h2": [("a", "/x/2")],
+    }
+    assert federate.where_else(aggregate, "a", "/x/1") == ("h1", [("b", "/y/1")])
+    assert federate.where_else(aggregate, "a", "/missing") is None
+    assert list(federate.get_cross_host_duplicates(aggregate)) == [
+        ("h1", 10, [("a", "/x/1"), ("b", "/y/1")])
+    ]
+
+
+def test_incremental_export(make_conn, aggregate):
+    host = make_host_db(make_conn, "a", {"/x/1": "h1", "/x/2": "h2"})
+    header, data = export_to_bytes(host, "a")
+    merge(aggregate, data)
+    assert federate.get_hosts(aggregate) == [("a", header["seq"], 50)]
+
+    db.update_file_data(host, "h3", 10, "/x/1", 200, 2)
+    db.update_deleted_file_data(host, "/x/2", 3)
+    db.update_file_data(host, "h4", 10, "/x/4", 300, 4)
+    host.commit()
+
+    header, data = export_to_bytes(host, "a", since=header["seq"])
+    assert merge(aggregate, data) == (header, 3)
+    assert federate.lookup_hashes(aggregate, ["h1", "h2", "h3", "h4"]) == {
+        "h3": [("a", "/x/1")],
+        "h4": [("a", "/x/4")],
+    }
+    # Replaced and deleted files are kept as history.
+    assert aggregate.execute(
+        "select path, hash, deleted_before from entries "
+        "where deleted_before is not null order by path"
+    ).fetchall() == [("/x/1", "h1", 50), ("/x/2", "h2", 3)]
+
+    # Merging the same export again changes nothing.
+    merge(aggregate, data)
+    assert aggregate.execute("select count(*) from entries").fetchone() == (4,)
+
+
+def test_merge_errors(make_conn, aggregate):
+    host = make_host_db(make_conn, "a", {"/x/1": "h1"})
+    header, full = export_to_bytes(host, "a")
+    _, incremental = export_to_bytes(host, "a", since=header["seq"])
+
+    with pytest.raises(ValueError):
+        merge(aggregate, incremental)
+    merge(aggregate, full)
+
+    db.update_file_data(host, "h2", 10, "/x/2", 100, 2)
+    host.commit()
+    _, later = export_to_bytes(host, "a", since=header["seq"] + 1)
+    with pytest.raises(ValueError):
+        merge(aggregate, later)
+
+    with pytest.raises(ValueError):
+        merge(aggregate, federate.gzip.compress(b'{"format": "other"}\n'))
+
+    # A full export older than what's been merged would roll the host back.
+    _, newer = export_to_bytes(host, "a")
+    merge(aggregate, newer)
+    with pytest.raises(ValueError):
+        merge(aggregate, full)
+    assert federate.lookup_hashes(aggregate, ["h2"]) == {"h2": [("a", "/x/2")]}
+    federate.merge_export(aggregate, io.BytesIO(full), force=True)
+    assert federate.lookup_hashes(aggregate, ["h2"]) == {}
+    assert federate.get_hosts(aggregate) == [("a", header["seq"], 50)]
+
+
+def test_full_export_with_history(make_conn, aggregate):
+    host = make_host_db(make_conn, "a", {"/x/1": "h1"})
+    db.update_deleted_file_data(host, "/x/1", 2)
+    db.update_file_data(host, "h2", 10, "/x/2", 100, 3)
+    host.commit()
+
+    header, data = export_to_bytes(host, "a", history=True)
+    assert header["history"]
+    assert merge(aggregate, data) == (header, 2)
+    merge(aggregate, data)
+    assert aggregate.execute(
+        "select path, hash, deleted_before from entries order by path"
+    ).fetchall() == [("/x/1", "h1", 2), ("/x/2", "h2", None)]
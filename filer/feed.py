@@ -0,0 +1,114 @@
+"""A feed of content changes, served over a unix socket in the db directory.
+
+Subscribers connect and send a line holding the sequence number of the last
+change they've seen (0 to start from the oldest change in the log).  They're
+then sent every later change as a line of JSON, followed by new changes as
+they're committed.  If changes they've not seen have already been pruned
+from the log, they're sent a single line of JSON with an "error" of
+"expired" instead, and need to resynchronise from the files table.
+
+"""
+
+import asyncio
+import json
+import os
+import socket
+
+from . import db
+
+FEED_SOCKET = "feed.sock"
+
+CHANGE_FIELDS = ("seq", "path", "old_hash", "new_hash", "event", "timestamp")
+
+
+def socket_path(config):
+    return os.path.join(config.db_dir, FEED_SOCKET)
+
+
+class ChangeFeed:
+    """Serves the change log to subscribers.
+
+    The log is read through a read-only connection of the feed's own, so
+    subscribers only see changes once they've been committed.
+
+    """
+
+    def __init__(self, config):
+        self.connection = db.connect(config, read_only=True)
+        self.path = socket_path(config)
+        self.changed = asyncio.Event()
+        self.server = None
+
+    async def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = await asyncio.start_unix_server(
+            self.handle_subscriber, path=self.path
+        )
+
+    def stop(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        self.connection.close()
+
+    def notify(self):
+        """Wake subscribers after new changes have been committed."""
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def handle_subscriber(self, reader, writer):
+        try:
+            line = await reader.readline()
+            try:
+                seq = int(line.strip() or 0)
+            except ValueError:
+                await self.send(writer, {"error": "bad sequence number"})
+                return
+
+            if db.changes_expired(self.connection, seq):
+                await self.send(writer, {"error": "expired"})
+                return
+
+            while True:
+                changed = self.changed
+                changes = db.get_changes(self.connection, seq)
+                if len(changes) == 0:
+                    await changed.wait()
+                    continue
+                for change in changes:
+                    writer.write(
+                        json.dumps(dict(zip(CHANGE_FIELDS, change))).encode("utf8")
+                        + b"\n"
+                    )
+                seq = changes[-1][0]
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def send(self, writer, item):
+        writer.write(json.dumps(item).encode("utf8") + b"\n")
+        await writer.drain()
+
+
+def follow(path, seq=0):
+    """Connect to a change feed, and return an iterator over changes.
+
+    Each change is a dict with the keys in CHANGE_FIELDS.  Raises ValueError
+    if the requested changes are no longer available.
+
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall("{}\n".format(seq).encode("utf8"))
+        with sock.makefile("rb") as fobj:
+            for line in fobj:
+                item = json.loads(line.decode("utf8"))
+                if "error" in item:
+                    raise ValueError("Change feed error: {}".format(item["error"]))
+                yield item
+    finally:
+        sock.close()
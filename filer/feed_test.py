@@ -0,0 +1,66 @@
+from . import config
+from . import db
+from . import feed
+import asyncio
+import json
+
+
+async def read_changes(reader, count):
+    lines = [await reader.readline() for _ in range(count)]
+    return [json.loads(line) for line in lines]
+
+
+def test_feed(conn, tmp_path):
+    async def run():
+        change_feed = feed.ChangeFeed(
+            config.load_config_from_data({"db": {"dir": str(tmp_path)}})
+        )
+        await change_feed.start()
+
+        db.update_file_data(conn, "h1", 10, "/a/f1", 100, 1)
+        db.update_file_data(conn, "h2", 10, "/a/f2", 100, 1)
+        conn.commit()
+
+        reader, writer = await asyncio.open_unix_connection(change_feed.path)
+        writer.write(b"1\n")
+        changes = await read_changes(reader, 1)
+        assert changes == [
+            {
+                "seq": 2,
+                "path": "/a/f2",
+                "old_hash": None,
+                "new_hash": "h2",
+                "event": "created",
+                "timestamp": 1,
+            }
+        ]
+
+        db.update_deleted_file_data(conn, "/a/f1", 2)
+        conn.commit()
+        change_feed.notify()
+        changes = await asyncio.wait_for(read_changes(reader, 1), 5)
+        assert changes[0]["seq"] == 3
+        assert changes[0]["event"] == "deleted"
+
+        # Uncommitted changes aren't sent.
+        db.update_file_data(conn, "h3", 10, "/a/f3", 100, 3)
+        change_feed.notify()
+        pending = asyncio.ensure_future(read_changes(reader, 1))
+        await asyncio.sleep(0.2)
+        assert not pending.done()
+        conn.commit()
+        change_feed.notify()
+        changes = await asyncio.wait_for(pending, 5)
+        assert (changes[0]["seq"], changes[0]["path"]) == (4, "/a/f3")
+        writer.close()
+
+        db.prune_changes(conn, 2)
+        conn.commit()
+        reader, writer = await asyncio.open_unix_connection(change_feed.path)
+        writer.write(b"0\n")
+        assert await read_changes(reader, 1) == [{"error": "expired"}]
+        writer.close()
+
+        change_feed.stop()
+
+    asyncio.run(run())
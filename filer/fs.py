@@ -0,0 +1,425 @@
+"""A read-only FUSE filesystem serving files from the index.
+
+The filesystem has two top level directories:
+
+ - by-hash/<digest>: a file for each current content hash
+ - by-path/...: the indexed directory tree
+
+Data is read straight from the index, and reads of file contents are passed
+through to a current on-disk copy of the file.  Attributes and directory
+listings are cached until the index changes.
+
+"""
+
+import argparse
+import errno
+import os
+import stat
+import time
+
+import pyfuse3
+import trio
+
+from . import config
+from . import db
+
+BY_HASH_INODE = pyfuse3.ROOT_INODE + 1
+BY_PATH_INODE = pyfuse3.ROOT_INODE + 2
+FIRST_DYNAMIC_INODE = pyfuse3.ROOT_INODE + 3
+
+ROOT_KEY = ("root",)
+BY_HASH_KEY = ("by-hash",)
+BY_PATH_KEY = ("dir", "/")
+
+HASH_PAGE_SIZE = 1000
+
+
+class ConnectionPool:
+    """A pool of read-only database connections, used from worker threads."""
+
+    def __init__(self, config, size=4):
+        self.connections = [
+            db.connect(config, read_only=True, check_same_thread=False)
+            for _ in range(size)
+        ]
+        self.free = list(self.connections)
+        self.available = trio.Semaphore(size)
+
+    async def run(self, func, *args):
+        """Call func(connection, *args) in a worker thread."""
+        async with self.available:
+            conn = self.free.pop()
+            try:
+                return await trio.to_thread.run_sync(func, conn, *args)
+            finally:
+                self.free.append(conn)
+
+    def close(self):
+        for conn in self.connections:
+            conn.close()
+
+
+class InodeTable:
+    """Allocates inode numbers for index entries.
+
+    Entries are identified by keys: ("dir", path), ("file", path) or
+    ("hash", digest).  Inodes are freed once the kernel has forgotten all
+    the lookups of them.
+
+    """
+
+    def __init__(self):
+        self.keys = {}
+        self.inodes = {}
+        self.lookups = {}
+        self.next_inode = FIRST_DYNAMIC_INODE
+        for inode, key in (
+            (pyfuse3.ROOT_INODE, ROOT_KEY),
+            (BY_HASH_INODE, BY_HASH_KEY),
+            (BY_PATH_INODE, BY_PATH_KEY),
+        ):
+            self.keys[inode] = key
+            self.inodes[key] = inode
+
+    def inode(self, key):
+        inode = self.inodes.get(key)
+        if inode is None:
+            inode = self.next_inode
+            self.next_inode += 1
+            self.keys[inode] = key
+            self.inodes[key] = inode
+        return inode
+
+    def key(self, inode):
+        return self.keys.get(inode)
+
+    def looked_up(self, inode):
+        if inode >= FIRST_DYNAMIC_INODE:
+            self.lookups[inode] = self.lookups.get(inode, 0) + 1
+
+    def forget(self, inode, nlookup):
+        """Return True if the inode has been freed."""
+        count = self.lookups.get(inode)
+        if count is None:
+            return False
+        count -= nlookup
+        if count > 0:
+            self.lookups[inode] = count
+            return False
+        del self.lookups[inode]
+        del self.inodes[self.keys.pop(inode)]
+        return True
+
+
+class FilerOperations(pyfuse3.Operations):
+    attr_timeout = 10
+    version_check_interval = 1.0
+
+    def __init__(self, pool, version_conn):
+        super().__init__()
+        self.pool = pool
+        self.version_conn = version_conn
+        self.data_version = None
+        self.version_checked = None
+        self.inodes = InodeTable()
+        self.uid = os.getuid()
+        self.gid = os.getgid()
+        # page number -> hash that the page starts after.  These are kept when
+        # the index changes, so a listing in progress carries on from the
+        # hash it reached rather than paging through from the start again.
+        self.hash_page_starts = {0: ""}
+        self.clear_caches()
+
+    def clear_caches(self):
+        self.attrs = {}
+        # inode -> (entries, index of entries by name)
+        self.listings = {}
+        self.hash_page = None
+
+    def check_version(self):
+        """Drop cached data if the index has changed since it was read.
+
+        The check is a cheap pragma, but is still only done at most once per
+        version_check_interval.
+
+        """
+        now = time.monotonic()
+        if self.version_checked is not None:
+            if now - self.version_checked < self.version_check_interval:
+                return
+        self.version_checked = now
+        version = db.get_data_version(self.version_conn)
+        if version != self.data_version:
+            self.data_version = version
+            self.clear_caches()
+
+    def make_attr(self, inode, is_dir, size, mtime):
+        attr = self.attrs.get(inode)
+        if attr is not None:
+            return attr
+        attr = pyfuse3.EntryAttributes()
+        attr.st_ino = inode
+        if is_dir:
+            attr.st_mode = stat.S_IFDIR | 0o555
+            attr.st_nlink = 2
+        else:
+            attr.st_mode = stat.S_IFREG | 0o444
+            attr.st_nlink = 1
+        attr.st_size = size
+        attr.st_uid = self.uid
+        attr.st_gid = self.gid
+        attr.st_atime_ns = attr.st_mtime_ns = attr.st_ctime_ns = int(mtime * 1e9)
+        attr.entry_timeout = self.attr_timeout
+        attr.attr_timeout = self.attr_timeout
+        self.attrs[inode] = attr
+        return attr
+
+    async def key_info(self, key):
+        """Return (is_dir, size, mtime) for a key, or None if it's not present."""
+        kind = key[0]
+        if kind in ("root", "by-hash"):
+            return True, 0, 0
+        if kind == "dir":
+            info = await self.pool.run(db.get_dir_info, key[1])
+            if info is None:
+                if key == BY_PATH_KEY:
+                    return True, 0, 0
+                return None
+            return True, info[0] or 0, info[1] or 0
+        if kind == "file":
+            info = await self.pool.run(db.get_file_info, key[1])
+            if info is None:
+                return None
+            return False, info[1] or 0, info[2] or 0
+        if kind == "hash":
+            locations = await self.pool.run(db.get_hash_locations, key[1])
+            if len(locations) == 0:
+                return None
+            _, size, mtime = locations[0]
+            return False, size or 0, mtime or 0
+        return None
+
+    async def getattr(self, inode, ctx=None):
+        self.check_version()
+        attr = self.attrs.get(inode)
+        if attr is not None:
+            return attr
+        key = self.inodes.key(inode)
+        if key is None:
+            raise pyfuse3.FUSEError(errno.ENOENT)
+        info = await self.key_info(key)
+        if info is None:
+            raise pyfuse3.FUSEError(errno.ENOENT)
+        return self.make_attr(inode, *info)
+
+    async def lookup(self, parent_inode, name, ctx=None):
+        self.check_version()
+        parent_key = self.inodes.key(parent_inode)
+        if parent_key is None:
+            raise pyfuse3.FUSEError(errno.ENOENT)
+
+        listing = self.listings.get(parent_inode)
+        if listing is not None:
+            entries, by_name = listing
+            index = by_name.get(name)
+            if index is None:
+                raise pyfuse3.FUSEError(errno.ENOENT)
+            _, key, info = entries[index]
+        else:
+            key = self.child_key(parent_key, os.fsdecode(name))
+            if key is None:
+                raise pyfuse3.FUSEError(errno.ENOENT)
+            info = await self.key_info(key)
+            if info is None and key[0] == "dir":
+                key = ("file", key[1])
+                info = await self.key_info(key)
+            if info is None:
+                raise pyfuse3.FUSEError(errno.ENOENT)
+
+        inode = self.inodes.inode(key)
+        self.inodes.looked_up(inode)
+        return self.make_attr(inode, *info)
+
+    def child_key(self, parent_key, name):
+        kind = parent_key[0]
+        if kind == "root":
+            return {"by-hash": BY_HASH_KEY, "by-path": BY_PATH_KEY}.get(name)
+        if kind == "by-hash":
+            return ("hash", name)
+        if kind == "dir":
+            return ("dir", os.path.join(parent_key[1], name))
+        return None
+
+    def forget(self, inode_list):
+        for inode, nlookup in inode_list:
+            if self.inodes.forget(inode, nlookup):
+                self.attrs.pop(inode, None)
+                self.listings.pop(inode, None)
+
+    async def opendir(self, inode, ctx):
+        self.check_version()
+        key = self.inodes.key(inode)
+        if key is None:
+            raise pyfuse3.FUSEError(errno.ENOENT)
+        if key[0] not in ("root", "by-hash", "dir"):
+            raise pyfuse3.FUSEError(errno.ENOTDIR)
+        return inode
+
+    async def listing(self, inode, key):
+        """Return the cached entries of a directory, reading them if needed.
+
+        Each entry is a (name, key, (is_dir, size, mtime)) tuple.
+
+        """
+        listing = self.listings.get(inode)
+        if listing is None:
+            if key == ROOT_KEY:
+                entries = [
+                    (b"by-hash", BY_HASH_KEY, (True, 0, 0)),
+                    (b"by-path", BY_PATH_KEY, (True, 0, 0)),
+                ]
+            else:
+                path = key[1]
+                entries = [
+                    (
+                        os.fsencode(name),
+                        ("dir" if is_dir else "file", os.path.join(path, name)),
+                        (is_dir, size, mtime),
+                    )
+                    for name, is_dir, size, mtime in await self.pool.run(
+                        db.get_dir_entries, path
+                    )
+                ]
+            by_name = {entry[0]: index for index, entry in enumerate(entries)}
+            listing = (entries, by_name)
+            self.listings[inode] = listing
+        return listing[0]
+
+    async def readdir(self, fh, start_id, token):
+        key = self.inodes.key(fh)
+        if key is None:
+            raise pyfuse3.FUSEError(errno.ENOENT)
+        if key == BY_HASH_KEY:
+            await self.readdir_hashes(start_id, token)
+            return
+
+        entries = await self.listing(fh, key)
+        for index in range(start_id, len(entries)):
+            name, child_key, info = entries[index]
+            inode = self.inodes.inode(child_key)
+            attr = self.make_attr(inode, *info)
+            if not pyfuse3.readdir_reply(token, name, attr, index + 1):
+                return
+            self.inodes.looked_up(inode)
+
+    async def get_hash_page(self, page_no):
+        """Return the rows of a page of the by-hash listing.
+
+        Only the most recently read page is kept, along with the hash each
+        page starts after, so listing all the hashes in a huge index needs
+        little memory, and each page is read with a single index seek.  If
+        the index changes during a listing, entries near page boundaries may
+        be repeated or skipped, as with any directory changing while it's
+        read.
+
+        """
+        if self.hash_page is not None and self.hash_page[0] == page_no:
+            return self.hash_page[1]
+
+        known = page_no
+        while known not in self.hash_page_starts:
+            known -= 1
+        while True:
+            rows = await self.pool.run(
+                db.get_hashes_page, self.hash_page_starts[known], HASH_PAGE_SIZE
+            )
+            if known == page_no:
+                break
+            if len(rows) < HASH_PAGE_SIZE:
+                return []
+            known += 1
+            self.hash_page_starts[known] = rows[-1][0]
+
+        if len(rows) == HASH_PAGE_SIZE:
+            self.hash_page_starts[page_no + 1] = rows[-1][0]
+        self.hash_page = (page_no, rows)
+        return rows
+
+    async def readdir_hashes(self, start_id, token):
+        page_no = start_id // HASH_PAGE_SIZE
+        offset = start_id % HASH_PAGE_SIZE
+        while True:
+            rows = await self.get_hash_page(page_no)
+            for index in range(offset, len(rows)):
+                digest, size, mtime = rows[index]
+                inode = self.inodes.inode(("hash", digest))
+                attr = self.make_attr(inode, False, size or 0, mtime or 0)
+                next_id = page_no * HASH_PAGE_SIZE + index + 1
+                if not pyfuse3.readdir_reply(token, os.fsencode(digest), attr, next_id):
+                    return
+                self.inodes.looked_up(inode)
+            if len(rows) < HASH_PAGE_SIZE:
+                return
+            page_no += 1
+            offset = 0
+
+    async def releasedir(self, fh):
+        pass
+
+    async def open(self, inode, flags, ctx):
+        if flags & (os.O_WRONLY | os.O_RDWR):
+            raise pyfuse3.FUSEError(errno.EROFS)
+        key = self.inodes.key(inode)
+        if key is None:
+            raise pyfuse3.FUSEError(errno.ENOENT)
+
+        if key[0] == "file":
+            info = await self.pool.run(db.get_file_info, key[1])
+            locations = [] if info is None else [(key[1], info[1], info[2])]
+        elif key[0] == "hash":
+            locations = await self.pool.run(db.get_hash_locations, key[1])
+        else:
+            raise pyfuse3.FUSEError(errno.EISDIR)
+
+        # Use the first copy which hasn't changed since it was indexed.
+        for path, _, mtime in locations:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError:
+                continue
+            if int(os.fstat(fd).st_mtime) == mtime:
+                return pyfuse3.FileInfo(fh=fd, keep_cache=True)
+            os.close(fd)
+        raise pyfuse3.FUSEError(errno.ENOENT)
+
+    async def read(self, fh, off, size):
+        return await trio.to_thread.run_sync(os.pread, fh, size, off)
+
+    async def release(self, fh):
+        os.close(fh)
+
+
+def run():
+    parser = argparse.ArgumentParser(
+        description="Mount a read-only view of the files in the index."
+    )
+    parser.add_argument("mountpoint", help="Directory to mount the filesystem on")
+    parser.add_argument(
+        "--debug-fuse", action="store_true", help="Enable FUSE debugging output"
+    )
+    args = parser.parse_args()
+
+    pool = ConnectionPool(config.get_config())
+    operations = FilerOperations(pool, db.connect(config.get_config()))
+
+    fuse_options = set(pyfuse3.default_options)
+    fuse_options.add("fsname=filerfs")
+    fuse_options.add("ro")
+    if args.debug_fuse:
+        fuse_options.add("debug")
+    pyfuse3.init(operations, args.mountpoint, fuse_options)
+    try:
+        trio.run(pyfuse3.main)
+    finally:
+        pyfuse3.close(unmount=True)
+        pool.close()
@@ -0,0 +1,162 @@
+from . import config
+from . import db
+import errno
+import pytest
+
+pyfuse3 = pytest.importorskip("pyfuse3")
+trio = pytest.importorskip("trio")
+
+from . import fs
+
+
+class ReaddirToken:
+    """Collects the replies to a readdir call, accepting up to limit."""
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.entries = []
+
+
+@pytest.fixture(autouse=True)
+def fake_readdir_reply(monkeypatch):
+    def readdir_reply(token, name, attr, next_id):
+        if token.limit is not None and len(token.entries) >= token.limit:
+            return False
+        token.entries.append((name, attr.st_ino, next_id))
+        return True
+
+    monkeypatch.setattr(fs.pyfuse3, "readdir_reply", readdir_reply)
+
+
+@pytest.fixture
+def operations(tmp_path, conn):
+    db.update_file_data(conn, "h1", 10, "/r/a/f1", 100, 1)
+    db.update_file_data(conn, "h1", 10, "/r/f1", 200, 1)
+    db.update_file_data(conn, "h2", 20, "/r/f2", 300, 1)
+    db.record_dir_mtime(conn, "/r/a", 50, 1)
+    db.refresh_dir_summaries(conn, 1)
+    conn.commit()
+
+    fs_config = config.load_config_from_data({"db": {"dir": str(tmp_path)}})
+    pool = fs.ConnectionPool(fs_config, size=1)
+    version_conn = db.connect(fs_config)
+    yield fs.FilerOperations(pool, version_conn)
+    pool.close()
+    version_conn.close()
+
+
+def run(func, *args):
+    return trio.run(func, *args)
+
+
+def readdir(operations, inode, start_id=0, limit=None):
+    token = ReaddirToken(limit)
+    run(operations.readdir, inode, start_id, token)
+    return token.entries
+
+
+def lookup(operations, parent_inode, name):
+    return run(operations.lookup, parent_inode, name)
+
+
+def test_inode_table():
+    table = fs.InodeTable()
+    assert table.key(pyfuse3.ROOT_INODE) == fs.ROOT_KEY
+    inode = table.inode(("file", "/r/f1"))
+    assert inode == fs.FIRST_DYNAMIC_INODE
+    assert table.inode(("file", "/r/f1")) == inode
+    assert table.inode(("file", "/r/f2")) == inode + 1
+
+    table.looked_up(inode)
+    table.looked_up(inode)
+    assert not table.forget(inode, 1)
+    assert table.key(inode) == ("file", "/r/f1")
+    assert table.forget(inode, 1)
+    assert table.key(inode) is None
+    # A forgotten key gets a new inode, as the kernel may still cache the old
+    assert table.inode(("file", "/r/f1")) == inode + 2
+
+    # The fixed inodes are never freed
+    table.looked_up(fs.BY_PATH_INODE)
+    assert not table.forget(fs.BY_PATH_INODE, 1)
+    assert table.key(fs.BY_PATH_INODE) == fs.BY_PATH_KEY
+
+
+def test_lookup_by_path(operations):
+    by_path = lookup(operations, pyfuse3.ROOT_INODE, b"by-path")
+    assert by_path.st_ino == fs.BY_PATH_INODE
+    r = lookup(operations, fs.BY_PATH_INODE, b"r")
+    assert r.st_size == 40
+    a = lookup(operations, r.st_ino, b"a")
+    assert (a.st_size, a.st_mtime_ns) == (10, 50 * 10**9)
+    f2 = lookup(operations, r.st_ino, b"f2")
+    assert (f2.st_size, f2.st_mtime_ns) == (20, 300 * 10**9)
+    assert run(operations.getattr, f2.st_ino) is f2
+
+    with pytest.raises(pyfuse3.FUSEError) as e:
+        lookup(operations, r.st_ino, b"missing")
+    assert e.value.errno == errno.ENOENT
+
+
+def test_lookup_by_hash(operations):
+    attr = lookup(operations, fs.BY_HASH_INODE, b"h2")
+    assert attr.st_size == 20
+    with pytest.raises(pyfuse3.FUSEError):
+        lookup(operations, fs.BY_HASH_INODE, b"h3")
+
+
+def test_readdir(operations):
+    assert [name for name, _, _ in readdir(operations, pyfuse3.ROOT_INODE)] == [
+        b"by-hash",
+        b"by-path",
+    ]
+    r = lookup(operations, fs.BY_PATH_INODE, b"r")
+    entries = readdir(operations, r.st_ino, limit=2)
+    assert [(name, next_id) for name, _, next_id in entries] == [
+        (b"a", 1),
+        (b"f1", 2),
+    ]
+    entries += readdir(operations, r.st_ino, start_id=2)
+    assert [name for name, _, _ in entries] == [b"a", b"f1", b"f2"]
+    # Entries which were replied to are looked up, as the kernel may cache them
+    f2 = lookup(operations, r.st_ino, b"f2")
+    assert f2.st_ino == entries[2][1]
+    assert operations.inodes.lookups[f2.st_ino] == 2
+
+    operations.forget([(f2.st_ino, 2)])
+    assert operations.inodes.key(f2.st_ino) is None
+    assert f2.st_ino not in operations.attrs
+
+
+def test_readdir_hashes_in_pages(operations, conn, monkeypatch):
+    for i in range(3, 8):
+        db.update_file_data(conn, "h{}".format(i), i, "/r/g{}".format(i), i, 2)
+    conn.commit()
+    monkeypatch.setattr(fs, "HASH_PAGE_SIZE", 2)
+    pages_read = []
+    get_hashes_page = db.get_hashes_page
+
+    def counting_get_hashes_page(connection, after, limit):
+        pages_read.append(after)
+        return get_hashes_page(connection, after, limit)
+
+    monkeypatch.setattr(fs.db, "get_hashes_page", counting_get_hashes_page)
+
+    entries = []
+    while True:
+        start_id = entries[-1][2] if entries else 0
+        page = readdir(operations, fs.BY_HASH_INODE, start_id, limit=3)
+        if not page:
+            break
+        entries += page
+    names = [name for name, _, _ in entries]
+    assert names == [b"h1", b"h2", b"h3", b"h4", b"h5", b"h6", b"h7"]
+    assert [next_id for _, _, next_id in entries] == list(range(1, 8))
+    assert pages_read == ["", "h2", "h4", "h6"]
+
+    # Changes to the index don't send a listing back to the first page.
+    del pages_read[:]
+    operations.clear_caches()
+    entries = readdir(operations, fs.BY_HASH_INODE, 5)
+    assert [name for name, _, _ in entries] == [b"h6", b"h7"]
+    assert pages_read == ["h4", "h6"]
@@ -0,0 +1,132 @@
+"""Profiling which can be switched on and off in a running process.
+
+Stage timings record the wall-clock time spent in named stages of the work
+(eg, hashing or committing).  When timing is disabled, entering a stage
+costs a single attribute check.
+
+"""
+
+import cProfile
+import json
+import os
+import time
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.timer.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StageTimer:
+    """Accumulates wall-clock time spent in named stages."""
+
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        self.stats = {}
+
+    def stage(self, name):
+        """Return a context manager which times a block as part of a stage."""
+        if not self.enabled:
+            return NULL_STAGE
+        return _Stage(self, name)
+
+    def add(self, name, elapsed):
+        stats = self.stats.get(name)
+        if stats is None:
+            self.stats[name] = [1, elapsed, elapsed]
+        else:
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+    def summary(self):
+        return {
+            name: {
+                "count": count,
+                "total": total,
+                "mean": total / count,
+                "max": longest,
+            }
+            for name, (count, total, longest) in self.stats.items()
+        }
+
+
+class Profiler:
+    """Runs cProfile and stage timing together, writing results to a directory.
+
+    Each profiling session writes a `profile-<time>.prof` file (readable with
+    the pstats module or snakeviz) and a `timings-<time>.json` file.
+
+    """
+
+    def __init__(self, output_dir, stage_timer):
+        self.output_dir = output_dir
+        self.stage_timer = stage_timer
+        self.profile = None
+        self.started = None
+
+    @property
+    def running(self):
+        return self.profile is not None
+
+    def start(self):
+        if self.running:
+            return
+        self.stage_timer.reset()
+        self.stage_timer.enabled = True
+        self.started = time.time()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self):
+        """Stop profiling, and return the paths of the files written."""
+        if not self.running:
+            return None
+        self.profile.disable()
+        self.stage_timer.enabled = False
+
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        suffix = time.strftime("%Y%m%d-%H%M%S", time.localtime(self.started))
+        profile_path = os.path.join(self.output_dir, "profile-{}.prof".format(suffix))
+        timings_path = os.path.join(self.output_dir, "timings-{}.json".format(suffix))
+
+        self.profile.dump_stats(profile_path)
+        with open(timings_path, "w") as fobj:
+            json.dump(
+                {
+                    "started": self.started,
+                    "duration": time.time() - self.started,
+                    "stages": self.stage_timer.summary(),
+                },
+                fobj,
+                indent=2,
+                sort_keys=True,
+            )
+
+        self.profile = None
+        self.started = None
+        return profile_path, timings_path
@@ -0,0 +1,43 @@
+from . import profiling
+import json
+import pstats
+
+
+def test_stage_timer_disabled():
+    timer = profiling.StageTimer()
+    with timer.stage("hash"):
+        pass
+    assert timer.summary() == {}
+
+
+def test_stage_timer():
+    timer = profiling.StageTimer()
+    timer.enabled = True
+    for _ in range(3):
+        with timer.stage("hash"):
+            pass
+    with timer.stage("commit"):
+        pass
+    summary = timer.summary()
+    assert summary["hash"]["count"] == 3
+    assert summary["commit"]["count"] == 1
+    assert summary["hash"]["max"] <= summary["hash"]["total"]
+
+
+def test_profiler(tmp_path):
+    timer = profiling.StageTimer()
+    profiler = profiling.Profiler(str(tmp_path / "out"), timer)
+    assert profiler.stop() is None
+
+    profiler.start()
+    assert profiler.running
+    with timer.stage("batch"):
+        sum(range(1000))
+    profile_path, timings_path = profiler.stop()
+    assert not profiler.running
+    assert not timer.enabled
+
+    pstats.Stats(profile_path)
+    with open(timings_path) as fobj:
+        timings = json.load(fobj)
+    assert timings["stages"]["batch"]["count"] == 1
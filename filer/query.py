@@ -0,0 +1,164 @@
+"""Lightweight queries against the index.
+
+This only imports what it needs to read the database, and opens it
+read-only, so it starts quickly enough to be called from scripts many times
+over.  For many lookups, use --stdin to pass them all to a single process.
+
+Results are written as one line of JSON per query:
+
+    {"path": ..., "hash": ..., "mtime": ...}
+    {"hash": ..., "paths": [...]}
+
+"""
+
+import argparse
+import io
+import json
+import os
+import select
+import sqlite3
+import sys
+
+from . import config
+from . import db
+
+BATCH_SIZE = 500
+
+
+def lookup_paths(conn, paths, resolver=None):
+    """Return a list of results for a batch of paths, in the same order."""
+    if resolver is not None:
+        found = resolver.lookup(paths)
+    else:
+        rows = {row[1]: row for row in db.get_current_file_data(conn, paths)}
+        found = {path: rows.get(path) for path in paths}
+
+    results = []
+    for path in paths:
+        row = found[path]
+        if row is None:
+            results.append({"path": path, "hash": None})
+        else:
+            results.append({"path": path, "hash": row[0], "mtime": row[2]})
+    return results
+
+
+def lookup_hashes(conn, hashes):
+    return [
+        {
+            "hash": content_hash,
+            "paths": [path for path, _, _ in db.get_hash_locations(conn, content_hash)],
+        }
+        for content_hash in hashes
+    ]
+
+
+def input_batches(stream, size):
+    """Yield batches of up to size lines read from stream, without newlines.
+
+    A batch is cut short whenever no more input is waiting, so results for
+    input typed at a terminal or written a line at a time by another
+    program aren't held back until a whole batch has been read.  Lines are
+    decoded as paths, so names which aren't valid in the filesystem encoding
+    are passed through unchanged.
+
+    """
+    try:
+        fd = stream.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        yield from db.batches((line.rstrip("\n") for line in stream), size)
+        return
+
+    # Read the fd directly, as select() can't see data buffered by stream.
+    batch = []
+    partial = b""
+    while True:
+        if batch and not select.select([fd], [], [], 0)[0]:
+            yield batch
+            batch = []
+        data = os.read(fd, 64 * 1024)
+        if len(data) == 0:
+            break
+        lines = (partial + data).split(b"\n")
+        partial = lines.pop()
+        for line in lines:
+            batch.append(os.fsdecode(line))
+            if len(batch) >= size:
+                yield batch
+                batch = []
+    if partial:
+        batch.append(os.fsdecode(partial))
+    if batch:
+        yield batch
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description="Look up paths or hashes.")
+    parser.add_argument("items", nargs="*", help="Paths (or hashes) to look up")
+    parser.add_argument(
+        "--hash",
+        action="store_true",
+        help="Look up hashes, giving the current paths with each",
+    )
+    parser.add_argument(
+        "--stdin",
+        action="store_true",
+        help="Read items to look up from stdin, one per line",
+    )
+    parser.add_argument(
+        "--follow-symlinks",
+        action="store_true",
+        help="Resolve paths through the indexed symlinks",
+    )
+    parser.add_argument(
+        "--db-dir", help="Database directory to use, instead of reading config"
+    )
+    args = parser.parse_args(argv)
+
+    if args.db_dir:
+        query_config = config.load_config_from_data({"db": {"dir": args.db_dir}})
+    else:
+        query_config = config.get_config()
+        if query_config is None:
+            return 1
+
+    if args.stdin:
+        item_batches = input_batches(sys.stdin, BATCH_SIZE)
+    else:
+        item_batches = db.batches(args.items, BATCH_SIZE)
+
+    try:
+        conn = db.connect(query_config, read_only=True)
+    except sqlite3.Error as e:
+        print(
+            "Unable to open the index in {}: {}".format(query_config.db_dir, e),
+            file=sys.stderr,
+        )
+        return 1
+    try:
+        resolver = None
+        if args.follow_symlinks and not args.hash:
+            from .symlinks import SymlinkResolver
+
+            resolver = SymlinkResolver(conn)
+
+        for batch in item_batches:
+            if args.hash:
+                results = lookup_hashes(conn, batch)
+            else:
+                results = lookup_paths(conn, batch, resolver)
+            sys.stdout.write("".join(json.dumps(result) + "\n" for result in results))
+            sys.stdout.flush()
+    except sqlite3.Error as e:
+        print(
+            "Unable to read the index in {}: {}".format(query_config.db_dir, e),
+            file=sys.stderr,
+        )
+        return 1
+    finally:
+        conn.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(run())
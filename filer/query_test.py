@@ -0,0 +1,94 @@
+from . import db
+from . import query
+import io
+import json
+import os
+import subprocess
+import sys
+
+
+def add_files(conn):
+    db.update_file_data(conn, "h1", 10, "/r/a", 100, 1)
+    db.update_file_data(conn, "h1", 10, "/r/b", 200, 1)
+    db.update_symlink_data(conn, "/link", "/r", 1)
+    conn.commit()
+
+
+def run_query(args, capsys, stdin=None, monkeypatch=None):
+    if stdin is not None:
+        monkeypatch.setattr(sys, "stdin", io.StringIO(stdin))
+    assert query.run(args) == 0
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+
+
+def test_lookup_paths(tmp_path, conn, capsys):
+    add_files(conn)
+    args = ["--db-dir", str(tmp_path), "/r/a", "/missing", "/link/b"]
+    assert run_query(args, capsys) == [
+        {"path": "/r/a", "hash": "h1", "mtime": 100},
+        {"path": "/missing", "hash": None},
+        {"path": "/link/b", "hash": None},
+    ]
+    assert run_query(args + ["--follow-symlinks"], capsys)[2] == {
+        "path": "/link/b",
+        "hash": "h1",
+        "mtime": 200,
+    }
+
+
+def test_lookup_hashes_from_stdin(tmp_path, conn, capsys, monkeypatch):
+    add_files(conn)
+    results = run_query(
+        ["--db-dir", str(tmp_path), "--hash", "--stdin"],
+        capsys,
+        stdin="h1\nh2\n",
+        monkeypatch=monkeypatch,
+    )
+    assert results == [
+        {"hash": "h1", "paths": ["/r/a", "/r/b"]},
+        {"hash": "h2", "paths": []},
+    ]
+
+
+def test_input_batches_flush_when_idle():
+    read_fd, write_fd = os.pipe()
+    with os.fdopen(read_fd) as reader, os.fdopen(write_fd, "w") as writer:
+        batches = query.input_batches(reader, 500)
+        writer.write("a\nb\n")
+        writer.flush()
+        # Returned without waiting for more input
+        assert next(batches) == ["a", "b"]
+        writer.write("c\n")
+        writer.close()
+        assert list(batches) == [["c"]]
+
+    assert list(query.input_batches(io.StringIO("a\nb\nc\n"), 2)) == [
+        ["a", "b"],
+        ["c"],
+    ]
+
+
+def test_missing_db(tmp_path, capsys):
+    assert query.run(["--db-dir", str(tmp_path / "missing"), "/r/a"]) == 1
+    err = capsys.readouterr().err
+    assert err.startswith("Unable to open the index in ")
+    assert len(err.splitlines()) == 1
+
+    os.makedirs(str(tmp_path / "empty"))
+    (tmp_path / "empty" / db.DB_FILENAME).write_text("")
+    assert query.run(["--db-dir", str(tmp_path / "empty"), "/r/a"]) == 1
+    err = capsys.readouterr().err
+    assert err.startswith("Unable to read the index in ")
+    assert len(err.splitlines()) == 1
+
+
+def test_minimal_imports():
+    code = (
+        "import sys; import filer.query; "
+        "print(' '.join(m for m in ('filer.walker', 'asyncio', 'pyinotify') "
+        "if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", code], stdout=subprocess.PIPE, check=True
+    )
+    assert result.stdout.strip() == b""
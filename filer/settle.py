@@ -0,0 +1,114 @@
+"""Adaptive settle times.
+
+Files are only hashed once they've stopped changing for a while.  Rather than
+waiting the same time for every file, this keeps track of how often each
+path (and each directory) has been seen changing again before it settled,
+and backs off exponentially for paths which keep changing.  Paths with no
+recent history only wait the minimum settle time.
+
+"""
+
+import collections
+import os
+import re
+
+
+class SettlePolicy:
+    """Decides how long to wait for a file to settle before hashing it.
+
+    A path's churn level goes up by one each time it's seen with a new mtime
+    within its current settle time, or within rehash_window of the mtime it
+    was last hashed at, and halves when it's seen changing after a longer
+    quiet period.  A level of 0 waits settle_min_time; each level
+    above that doubles the wait from settle_time, up to settle_max_time.
+    New paths start from half the level of their directory, so files
+    appearing in busy directories (eg, build outputs) start warm.
+
+    Patterns in settle_overrides give a fixed settle time for matching paths.
+    They're tried in the order they appear in the config, and the first
+    pattern which matches wins.
+
+    """
+
+    def __init__(self, config, max_paths=100000, max_dirs=10000):
+        self.base_time = config.settle_time
+        self.min_time = config.settle_min_time
+        self.max_time = config.settle_max_time
+        self.overrides = [
+            (re.compile(pattern), seconds)
+            for pattern, seconds in config.settle_overrides
+        ]
+        self.max_paths = max_paths
+        self.max_dirs = max_dirs
+        # path -> [last seen mtime, churn level]
+        self.paths = collections.OrderedDict()
+        # dir path -> churn level
+        self.dirs = collections.OrderedDict()
+        # path -> mtime when last hashed, kept after the path's entry in
+        # paths is dropped, so files rewritten every minute or so back off
+        self.hashed = collections.OrderedDict()
+        self.rehash_window = 2 * self.base_time
+
+    def delay_for_level(self, level):
+        if level == 0:
+            return self.min_time
+        return min(self.max_time, self.base_time * 2 ** (level - 1))
+
+    def override(self, path):
+        for pattern, seconds in self.overrides:
+            if pattern.search(path):
+                return seconds
+        return None
+
+    def changed(self, path, mtime):
+        """Note that path has been seen with the given mtime.
+
+        Returns the time to wait after mtime before hashing the file.
+
+        """
+        seconds = self.override(path)
+        if seconds is not None:
+            return seconds
+
+        dirname = os.path.dirname(path)
+        hashed = self.hashed.get(path)
+        entry = self.paths.get(path)
+        if entry is None:
+            last_mtime = mtime if hashed is None else hashed
+            entry = [last_mtime, self.dirs.get(dirname, 0) // 2]
+            self.paths[path] = entry
+        if entry[0] != mtime:
+            rehashed = hashed is not None and mtime - hashed < self.rehash_window
+            if rehashed or mtime - entry[0] < self.delay_for_level(entry[1]):
+                entry[1] += 1
+                self._set_dir_level(dirname, max(entry[1], self.dirs.get(dirname, 0)))
+            else:
+                entry[1] //= 2
+                if dirname in self.dirs:
+                    self._set_dir_level(dirname, self.dirs[dirname] // 2)
+            entry[0] = mtime
+        self.paths.move_to_end(path)
+        if len(self.paths) > self.max_paths:
+            self.paths.popitem(last=False)
+
+        return self.delay_for_level(entry[1])
+
+    def settled(self, path, mtime):
+        """Note that path has been hashed at mtime, so can be forgotten if it's
+        cold."""
+        self.hashed[path] = mtime
+        self.hashed.move_to_end(path)
+        if len(self.hashed) > self.max_paths:
+            self.hashed.popitem(last=False)
+        entry = self.paths.get(path)
+        if entry is not None and entry[1] == 0:
+            del self.paths[path]
+
+    def _set_dir_level(self, dirname, level):
+        if level == 0:
+            self.dirs.pop(dirname, None)
+            return
+        self.dirs[dirname] = level
+        self.dirs.move_to_end(dirname)
+        if len(self.dirs) > self.max_dirs:
+            self.dirs.popitem(last=False)
@@ -0,0 +1,90 @@
+from . import config
+from . import settle
+
+
+def make_policy(**times):
+    times.setdefault("settle", 30)
+    return settle.SettlePolicy(config.load_config_from_data({"times": times}))
+
+
+def test_cold_file():
+    policy = make_policy(settle_min=5)
+    assert policy.changed("/a/file", 1000) == 5
+    # Seeing the same mtime again doesn't count as a change
+    assert policy.changed("/a/file", 1000) == 5
+    policy.settled("/a/file", 1000)
+    assert "/a/file" not in policy.paths
+
+
+def test_hot_file_backs_off():
+    policy = make_policy(settle_min=5, settle_max=100)
+    mtime = 1000
+    delays = [policy.changed("/a/log", mtime)]
+    for _ in range(5):
+        mtime += 2
+        delays.append(policy.changed("/a/log", mtime))
+    assert delays == [5, 30, 60, 100, 100, 100]
+
+    # A long quiet period cools the file down
+    assert policy.changed("/a/log", mtime + 1000) == 60
+
+    # New files in the same directory start warm
+    assert policy.changed("/a/other", mtime) == 30
+    assert policy.changed("/b/other", mtime) == 5
+
+
+def test_rehashed_file_backs_off():
+    policy = make_policy(settle_min=5, settle_max=1000)
+    # Rewritten every 10s, so hashed after each write until it warms up
+    mtime = 1000
+    delays = []
+    for _ in range(5):
+        delay = policy.changed("/a/db", mtime)
+        delays.append(delay)
+        if delay < 10:
+            policy.settled("/a/db", mtime)
+        mtime += 10
+    assert delays == [5, 30, 60, 120, 240]
+
+    # Rewrites further apart than the rehash window don't back off
+    policy = make_policy(settle_min=5)
+    for mtime in (1000, 1100, 1200):
+        assert policy.changed("/a/db", mtime) == 5
+        policy.settled("/a/db", mtime)
+    assert len(policy.hashed) == 1
+
+
+def test_overrides():
+    policy = make_policy(settle_overrides={r"\.sqlite$": 600})
+    assert policy.changed("/a/db.sqlite", 1000) == 600
+    assert policy.changed("/a/db.sqlite", 1001) == 600
+    assert "/a/db.sqlite" not in policy.paths
+
+
+def test_first_matching_override_wins():
+    policy = make_policy(settle_overrides={r"\.sqlite$": 600, r"/tmp/": 1})
+    assert policy.changed("/tmp/db.sqlite", 1000) == 600
+    assert policy.changed("/tmp/log", 1000) == 1
+
+
+def test_bounded_memory():
+    policy = settle.SettlePolicy(
+        config.load_config_from_data({}), max_paths=10, max_dirs=2
+    )
+    for i in range(100):
+        path = "/d{}/f".format(i)
+        policy.changed(path, 1000)
+        policy.changed(path, 1001)
+    assert len(policy.paths) == 10
+    assert len(policy.dirs) == 2
+    for i in range(100):
+        policy.settled("/d{}/f".format(i), 1001)
+    assert len(policy.hashed) == 10
+
+
+def test_config_limits():
+    value = config.load_config_from_data({"times": {"settle": 3}})
+    assert value.settle_min_time == 3
+    assert value.settle_max_time == 3600
+    value = config.load_config_from_data({"times": {"settle": 0}})
+    assert (value.settle_min_time, value.settle_max_time) == (0, 3600)
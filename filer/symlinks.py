@@ -0,0 +1,126 @@
+"""Resolution of paths through the symlinks stored in the database.
+
+Paths are resolved using only the stored symlinks, without touching the
+filesystem, so a path is only resolved correctly if every intermediate
+symlink is under one of the monitored roots.  Each path component is looked
+up with an indexed query, so only the symlinks actually passed through are
+read.
+
+"""
+
+import collections
+import os
+
+from . import db
+
+
+class SymlinkLoop(ValueError):
+    pass
+
+
+class SymlinkResolver:
+    """Maps paths through stored symlinks to canonical paths.
+
+    The target of each path component is looked up in the database when
+    it's first needed.  Up to max_cached component targets and resolved
+    paths are cached, dropping the least recently used, and both caches are
+    cleared by refresh() when the stored symlinks have changed.
+
+    """
+
+    max_hops = 40
+
+    def __init__(self, connection, max_cached=100000):
+        self.connection = connection
+        self.version = None
+        self.max_cached = max_cached
+        # path -> symlink target, or None if it isn't a symlink
+        self.targets = collections.OrderedDict()
+        self.cache = collections.OrderedDict()
+
+    def refresh(self):
+        """Drop the cached data if the symlinks have changed in the database."""
+        version = db.get_symlinks_version(self.connection)
+        if version == self.version:
+            return
+        self.targets.clear()
+        self.cache.clear()
+        self.version = version
+
+    def _remember(self, cache, key, value):
+        cache[key] = value
+        if len(cache) > self.max_cached:
+            cache.popitem(last=False)
+
+    def resolve(self, path):
+        """Return the canonical form of an absolute path.
+
+        Raises SymlinkLoop if resolving the path follows too many symlinks.
+
+        """
+        result = self.cache.get(path)
+        if result is None:
+            result = self._resolve(path)
+            self._remember(self.cache, path, result)
+        else:
+            self.cache.move_to_end(path)
+        return result
+
+    def target(self, path):
+        """Return the target of the symlink at path, or None."""
+        if path in self.targets:
+            self.targets.move_to_end(path)
+            return self.targets[path]
+        target = db.get_symlink_target(self.connection, path)
+        self._remember(self.targets, path, target)
+        return target
+
+    def _resolve(self, path):
+        hops = 0
+        resolved = "/"
+        pending = collections.deque(path.split("/"))
+        while pending:
+            part = pending.popleft()
+            if part == "" or part == ".":
+                continue
+            if part == "..":
+                resolved = os.path.dirname(resolved)
+                continue
+
+            candidate = os.path.join(resolved, part)
+            target = self.target(candidate)
+            if target is None:
+                resolved = candidate
+                continue
+
+            hops += 1
+            if hops > self.max_hops:
+                raise SymlinkLoop("Too many levels of symlinks: {}".format(path))
+            if target.startswith("/"):
+                resolved = "/"
+            pending.extendleft(reversed(target.split("/")))
+        return resolved
+
+    def lookup(self, paths):
+        """Look up the current data for some paths, following symlinks.
+
+        Returns a dict mapping each path to a (hash, canonical path, mtime)
+        tuple, or to None if there is no current file at the path.
+
+        """
+        self.refresh()
+        canonical = {}
+        for path in paths:
+            try:
+                canonical[path] = self.resolve(path)
+            except SymlinkLoop:
+                canonical[path] = None
+
+        stored = {
+            row[1]: row
+            for row in db.get_current_file_data(
+                self.connection,
+                list(set(path for path in canonical.values() if path is not None)),
+            )
+        }
+        return {path: stored.get(canonical[path]) for path in paths}
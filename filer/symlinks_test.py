@@ -0,0 +1,82 @@
+from . import db
+from . import symlinks
+import pytest
+
+
+def test_update_symlink_data(conn):
+    assert db.get_symlinks_version(conn) == 0
+    assert db.update_symlink_data(conn, "/a/link", "target", 1)
+    assert not db.update_symlink_data(conn, "/a/link", "target", 2)
+    assert db.get_symlinks_version(conn) == 1
+    assert db.update_symlink_data(conn, "/a/link", "other", 3)
+    assert list(db.get_current_symlinks(conn)) == [("/a/link", "other")]
+
+    assert db.update_deleted_symlink_data(conn, "/a/link", 4)
+    assert not db.update_deleted_symlink_data(conn, "/a/link", 5)
+    assert list(db.get_current_symlinks(conn)) == []
+    assert db.get_symlinks_version(conn) == 3
+
+
+def test_resolve(conn):
+    db.update_symlink_data(conn, "/data/current", "releases/2", 1)
+    db.update_symlink_data(conn, "/home/user/data", "/data", 1)
+    db.update_symlink_data(conn, "/home/user/up", "../user/data/current", 1)
+    resolver = symlinks.SymlinkResolver(conn)
+    resolver.refresh()
+
+    assert resolver.resolve("/plain/path") == "/plain/path"
+    assert resolver.resolve("/home/user/data/x") == "/data/x"
+    assert resolver.resolve("/home/user/data/current/x") == "/data/releases/2/x"
+    assert resolver.resolve("/home/user/up/x") == "/data/releases/2/x"
+    # ".." after a symlink applies to the link target, as in the kernel.
+    assert resolver.resolve("/home/user/data/current/../x") == "/data/releases/x"
+    assert resolver.resolve("/home/./user//data") == "/data"
+
+
+def test_resolve_loop(conn):
+    db.update_symlink_data(conn, "/a", "/b", 1)
+    db.update_symlink_data(conn, "/b", "/a", 1)
+    resolver = symlinks.SymlinkResolver(conn)
+    resolver.refresh()
+    with pytest.raises(symlinks.SymlinkLoop):
+        resolver.resolve("/a/x")
+
+
+def test_refresh(conn):
+    db.update_symlink_data(conn, "/link", "/one", 1)
+    resolver = symlinks.SymlinkResolver(conn)
+    resolver.refresh()
+    assert resolver.resolve("/link/x") == "/one/x"
+    # Only the components passed through are read from the database.
+    assert dict(resolver.targets) == {"/link": "/one", "/one": None, "/one/x": None}
+
+    db.update_symlink_data(conn, "/link", "/two", 2)
+    resolver.refresh()
+    assert resolver.resolve("/link/x") == "/two/x"
+    db.update_deleted_symlink_data(conn, "/link", 3)
+    resolver.refresh()
+    assert resolver.resolve("/link/x") == "/link/x"
+
+
+def test_lookup(conn):
+    db.update_file_data(conn, "abc", 10, "/real/dir/file", 100, 1)
+    db.update_symlink_data(conn, "/alias", "real/dir", 1)
+    resolver = symlinks.SymlinkResolver(conn)
+
+    result = resolver.lookup(["/alias/file", "/alias/missing"])
+    assert result["/alias/file"] == ("abc", "/real/dir/file", 100)
+    assert result["/alias/missing"] is None
+
+    # Changes recorded in the database are picked up on the next lookup.
+    db.update_symlink_data(conn, "/alias", "/elsewhere", 2)
+    conn.commit()
+    assert resolver.lookup(["/alias/file"]) == {"/alias/file": None}
+
+
+def test_cache_limit(conn):
+    resolver = symlinks.SymlinkResolver(conn, max_cached=2)
+    resolver.refresh()
+    for path in ("/a", "/b", "/a", "/c"):
+        resolver.resolve(path)
+    assert list(resolver.cache) == ["/a", "/c"]
+    assert list(resolver.targets) == ["/b", "/c"]
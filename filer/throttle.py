@@ -0,0 +1,225 @@
+"""Limits on the I/O done when hashing files.
+
+Reads are limited per device by token buckets for bytes read and files
+opened.  Small files are given priority over big ones: reading them uses up
+byte tokens but never waits for them, so they are hashed promptly while bulk
+re-hashing of big files is slowed down to stay within the limits.  Opening
+any file waits for the files limit, so small files can't flood the device
+either.
+
+The limits are kept by sleeping in the thread doing the reads, so hashing
+with limits enabled shouldn't be done on the event loop thread.
+
+"""
+
+import ctypes
+import os
+import platform
+import time
+
+# ioprio_set syscall numbers, by machine
+SYS_IOPRIO_SET = {
+    "x86_64": 251,
+    "i386": 289,
+    "i686": 289,
+    "aarch64": 30,
+    "armv7l": 314,
+    "ppc64le": 273,
+    "s390x": 282,
+    "riscv64": 30,
+}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+
+def set_idle_io_priority():
+    """Put the current process in the idle I/O scheduling class.
+
+    Returns True if this succeeded.
+
+    """
+    number = SYS_IOPRIO_SET.get(platform.machine())
+    if number is None:
+        return False
+    libc = ctypes.CDLL(None, use_errno=True)
+    result = libc.syscall(
+        number, IOPRIO_WHO_PROCESS, 0, IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT
+    )
+    return result == 0
+
+
+class TokenBucket:
+    """A token bucket which can go into debt.
+
+    take() always succeeds, and returns how long the caller should wait
+    before proceeding to keep to the rate.  The debt is capped at the larger
+    of burst and the amount taken, so takes whose callers don't wait can't
+    hold up later ones for more than about burst / rate.
+
+    """
+
+    def __init__(self, rate, burst=None, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+
+    def take(self, amount, rate_factor=1.0):
+        now = self.clock()
+        rate = self.rate * rate_factor
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        self.tokens = max(self.tokens - amount, -max(self.burst, amount))
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / rate
+
+
+class LatencyMonitor:
+    """Watches the average I/O latency of a device, from /proc/diskstats.
+
+    factor() returns a multiplier for the I/O limits, which is halved each
+    time the latency seen by all users of the device is over the target, and
+    recovers gradually once it's back under.
+
+    """
+
+    min_factor = 1 / 16
+    sample_interval = 1.0
+
+    def __init__(
+        self,
+        device,
+        target_latency,
+        diskstats_path="/proc/diskstats",
+        clock=time.monotonic,
+    ):
+        self.major = os.major(device)
+        self.minor = os.minor(device)
+        self.target_latency = target_latency
+        self.diskstats_path = diskstats_path
+        self.clock = clock
+        self.current = 1.0
+        self.last_sample = None
+        self.last_counts = self.read_counts()
+
+    def read_counts(self):
+        """Return (ios completed, ms spent on them) for the device, or None."""
+        try:
+            with open(self.diskstats_path) as fobj:
+                for line in fobj:
+                    fields = line.split()
+                    if int(fields[0]) == self.major and int(fields[1]) == self.minor:
+                        ios = int(fields[3]) + int(fields[7])
+                        ms = int(fields[6]) + int(fields[10])
+                        return ios, ms
+        except (OSError, ValueError, IndexError):
+            pass
+        return None
+
+    def factor(self):
+        now = self.clock()
+        if self.last_sample is not None:
+            if now - self.last_sample < self.sample_interval:
+                return self.current
+        self.last_sample = now
+
+        counts = self.read_counts()
+        if counts is None or self.last_counts is None:
+            self.last_counts = counts
+            return self.current
+        ios = counts[0] - self.last_counts[0]
+        ms = counts[1] - self.last_counts[1]
+        self.last_counts = counts
+        if ios <= 0:
+            latency = 0.0
+        else:
+            latency = ms / ios / 1000.0
+
+        if latency > self.target_latency:
+            self.current = max(self.min_factor, self.current / 2)
+        else:
+            self.current = min(1.0, self.current + 0.1)
+        return self.current
+
+
+class DeviceLimits:
+    def __init__(self, read_bytes_per_second, files_per_second, monitor, clock):
+        self.bytes = None
+        self.files = None
+        if read_bytes_per_second:
+            self.bytes = TokenBucket(read_bytes_per_second, clock=clock)
+        if files_per_second:
+            self.files = TokenBucket(files_per_second, clock=clock)
+        self.monitor = monitor
+
+
+class IOThrottle:
+    """Applies the configured I/O limits to reads of files."""
+
+    def __init__(self, io_config, clock=time.monotonic, sleep=time.sleep):
+        self.config = io_config
+        self.clock = clock
+        self.sleep = sleep
+        self.devices = {}
+        self.device_config = {}
+        for path, limits in io_config.limits.items():
+            try:
+                device = os.stat(path).st_dev
+            except OSError:
+                continue
+            self.device_config[device] = limits
+
+    @property
+    def enabled(self):
+        return bool(
+            self.config.read_bytes_per_second
+            or self.config.files_per_second
+            or self.config.limits
+        )
+
+    def limits_for(self, device):
+        limits = self.devices.get(device)
+        if limits is None:
+            config = self.device_config.get(device, {})
+            monitor = None
+            if self.config.adaptive:
+                monitor = LatencyMonitor(
+                    device, self.config.target_latency, clock=self.clock
+                )
+            limits = DeviceLimits(
+                config.get("read_bytes_per_second", self.config.read_bytes_per_second),
+                config.get("files_per_second", self.config.files_per_second),
+                monitor,
+                self.clock,
+            )
+            self.devices[device] = limits
+        return limits
+
+    def _take(self, limits, bucket, amount, wait=True):
+        if bucket is None:
+            return
+        factor = 1.0
+        if limits.monitor is not None:
+            factor = limits.monitor.factor()
+        delay = bucket.take(amount, factor)
+        if delay > 0 and wait:
+            self.sleep(delay)
+
+    def file_opened(self, device, filesize):
+        """Account for opening a file, waiting if needed."""
+        limits = self.limits_for(device)
+        self._take(limits, limits.files, 1)
+
+    def bytes_read(self, device, amount, filesize):
+        """Account for reading from a file, waiting if needed.
+
+        Reads from small files are counted, but never wait.
+
+        """
+        limits = self.limits_for(device)
+        self._take(
+            limits, limits.bytes, amount, filesize >= self.config.small_file_size
+        )
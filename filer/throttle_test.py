@@ -0,0 +1,114 @@
+from . import config
+from . import throttle
+import os
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.slept.append(delay)
+        self.now += delay
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = throttle.TokenBucket(100, clock=clock)
+    assert bucket.take(60) == 0
+    assert bucket.take(60) == 0.2
+    clock.now += 0.2
+    assert bucket.take(0) == 0
+    clock.now += 10
+    # Refills only up to the burst size
+    assert bucket.take(100) == 0
+    assert bucket.take(50, rate_factor=0.5) == 1.0
+
+
+def test_token_bucket_debt_is_capped():
+    clock = FakeClock()
+    bucket = throttle.TokenBucket(100, clock=clock)
+    for _ in range(10):
+        bucket.take(100)
+    assert bucket.take(0) == 1.0
+    # Unless a single take is bigger than the burst
+    assert bucket.take(300) == 3.0
+
+
+def test_throttle_prioritises_small_files(tmp_path):
+    clock = FakeClock()
+    io_config = config.load_config_from_data(
+        {"io": {"read_bytes_per_second": 1000, "small_file_size": 500}}
+    ).io
+    io_throttle = throttle.IOThrottle(io_config, clock=clock, sleep=clock.sleep)
+    assert io_throttle.enabled
+    device = os.stat(str(tmp_path)).st_dev
+
+    io_throttle.bytes_read(device, 1000, 100)
+    io_throttle.bytes_read(device, 400, 400)
+    assert clock.slept == []
+    io_throttle.bytes_read(device, 600, 2000)
+    assert clock.slept == [1.0]
+
+
+def test_throttle_limits_opening_small_files(tmp_path):
+    clock = FakeClock()
+    io_config = config.load_config_from_data(
+        {"io": {"files_per_second": 2, "small_file_size": 500}}
+    ).io
+    io_throttle = throttle.IOThrottle(io_config, clock=clock, sleep=clock.sleep)
+    device = os.stat(str(tmp_path)).st_dev
+    for _ in range(4):
+        io_throttle.file_opened(device, 100)
+    assert clock.slept == [0.5, 0.5]
+
+
+def test_throttle_limits_per_device(tmp_path):
+    clock = FakeClock()
+    io_config = config.load_config_from_data(
+        {"io": {"limits": {str(tmp_path): {"files_per_second": 2}}}}
+    ).io
+    io_throttle = throttle.IOThrottle(io_config, clock=clock, sleep=clock.sleep)
+    device = os.stat(str(tmp_path)).st_dev
+    for _ in range(4):
+        io_throttle.file_opened(device, 1024 * 1024 * 1024)
+    assert clock.slept == [0.5, 0.5]
+    # No byte limit configured
+    io_throttle.bytes_read(device, 10**9, 10**9)
+    assert clock.slept == [0.5, 0.5]
+
+
+def test_disabled():
+    io_throttle = throttle.IOThrottle(config.load_config_from_data({}).io)
+    assert not io_throttle.enabled
+
+
+def test_latency_monitor(tmp_path):
+    clock = FakeClock()
+    diskstats = tmp_path / "diskstats"
+    device = os.makedev(8, 1)
+
+    def write_stats(ios, ms):
+        diskstats.write_text(
+            "   8       0 sda 1 0 0 0 0 0 0 0 0 0 0 0 0 0\n"
+            "   8       1 sda1 {} 0 0 {} 0 0 0 0 0 0 0 0 0 0\n".format(ios, ms)
+        )
+
+    write_stats(0, 0)
+    monitor = throttle.LatencyMonitor(
+        device, 0.01, diskstats_path=str(diskstats), clock=clock
+    )
+    write_stats(100, 5000)
+    assert monitor.factor() == 0.5
+    # Not sampled again until the interval has passed
+    write_stats(200, 10000)
+    assert monitor.factor() == 0.5
+    clock.now += 1
+    assert monitor.factor() == 0.25
+    clock.now += 1
+    write_stats(300, 10100)
+    assert monitor.factor() == 0.35
@@ -2,13 +2,18 @@ import hashlib
 import heapq
 import os
 import re
+import signal
 import stat
-import subprocess
 import time
 import pyinotify
 import asyncio
+import collections
 
 from . import db
+from . import feed
+from . import profiling
+from . import settle
+from . import throttle
 
 
 REGULAR_FILE = 1
@@ -22,6 +27,14 @@ class Walker:
             re.compile(pattern) for pattern in config.exclude_patterns
         ]
         self.swapfiles = self.find_swapfiles()
+        self.io_throttle = throttle.IOThrottle(config.io)
+        # Throttled hashing waits in worker threads, so other tasks can run
+        # during a visit; this keeps visits of batches from overlapping.
+        self.visit_lock = asyncio.Lock()
+        self.settle_policy = settle.SettlePolicy(config)
+        if config.io.idle_priority:
+            if not throttle.set_idle_io_priority():
+                self.log("Unable to set idle I/O priority")
         self.db_conn = db.connect(self.config, read_only=False)
         db.init_schema(self.db_conn)
         self.batch_size = 1000
@@ -42,44 +55,92 @@ class Walker:
             | pyinotify.IN_EXCL_UNLINK
         )
         self.loop = asyncio.get_event_loop()
+        self.notifier = None
+        # path -> watch descriptor, as pyinotify's get_wd() is a linear scan
+        self.watched = {}
+        # Directories queued by catch-up scans but not yet listed
+        self.catch_up_queued = set()
+        self.catch_up_parallelism = 4
+        self.catch_up_limit = asyncio.Semaphore(self.catch_up_parallelism)
+        self.recent_dirs = collections.OrderedDict()
+        self.max_recent_dirs = 10000
+        self.rescan_rate = 1000
+        self.overflow_rescan = None
+        self.overflow_again = False
+        self.checkpoint_interval = 60
+        self.change_feed = None
+        self.change_log_retention = 7 * 24 * 3600
+        self.profile_duration = config.profile_duration
+        self.stage_timer = profiling.StageTimer()
+        self.profiler = profiling.Profiler(self.config.db_dir, self.stage_timer)
 
     def log(self, message):
         print(message)
 
     def find_swapfiles(self):
-        result = subprocess.run(
-            ["/sbin/swapon", "--show=NAME", "--noheadings"], stdout=subprocess.PIPE
-        )
-        if result.returncode != 0:
+        """Return the paths of active swap files, from /proc/swaps."""
+        try:
+            with open("/proc/swaps") as fobj:
+                lines = fobj.read().splitlines()
+        except OSError:
             return []
-        return result.stdout.decode("utf8").strip().split("\n")
+        # The first line is a header.  Paths have spaces escaped as \040.
+        return [
+            line.split()[0].replace("\\040", " ") for line in lines[1:] if line.strip()
+        ]
 
     def calc_hash(self, path):
+        with self.stage_timer.stage("hash"):
+            return self._calc_hash(path)
+
+    def _calc_hash(self, path):
         self.log("Calculating hash of {}".format(path))
         filesize = 0
         try:
             h = hashlib.sha256()
             with open(path, "rb") as fobj:
+                if self.io_throttle.enabled:
+                    stats = os.fstat(fobj.fileno())
+                    self.io_throttle.file_opened(stats.st_dev, stats.st_size)
                 while True:
                     d = fobj.read(1024 * 128)
                     if len(d) == 0:
                         break
                     h.update(d)
                     filesize += len(d)
+                    if self.io_throttle.enabled:
+                        self.io_throttle.bytes_read(stats.st_dev, len(d), stats.st_size)
             return h.hexdigest(), filesize
         except PermissionError as e:
             self.log("PermissionError calculating hash for {} - skipping".format(path))
             return None, None
 
-    def visit_files(self, batch):
+    async def visit_files(self, batch):
+        async with self.visit_lock:
+            with self.stage_timer.stage("batch"):
+                return await self._visit_files(batch)
+
+    async def hash_file(self, path):
+        """Calculate the hash of a file, applying the I/O limits.
+
+        When the limits are enabled, hashing runs in a worker thread, as it
+        may sleep to keep to them.
+
+        """
+        if self.io_throttle.enabled:
+            return await self.loop.run_in_executor(None, self.calc_hash, path)
+        return self.calc_hash(path)
+
+    async def _visit_files(self, batch):
         revisits_queued = False
 
-        stored_data = {
-            path: (stored_hash, stored_mtime)
-            for stored_hash, path, stored_mtime in db.get_current_file_data(
-                self.db_conn, [path for path, _ in batch]
-            )
-        }
+        with self.stage_timer.stage("db"):
+            stored_data = {
+                path: (stored_hash, stored_mtime)
+                for stored_hash, path, stored_mtime in db.get_current_file_data(
+                    self.db_conn, [path for path, _ in batch]
+                )
+            }
         deletes = set()
 
         for path, mtime in batch:
@@ -103,9 +164,9 @@ class Walker:
                 )
                 old_hash = stored[0]
 
-            settled_time = mtime + self.config.settle_time
+            settled_time = mtime + self.settle_policy.changed(path, mtime)
             if now < settled_time:
-                # Changed more recently than settle_time
+                # Changed more recently than its settle time
                 self.log(
                     "file {} changed recently - will revisit after {}s".format(
                         path, settled_time - time.time()
@@ -124,16 +185,17 @@ class Walker:
 
             if new_mtime != mtime:
                 # Changed since we logged this as something to be visited - revisit again later.
+                settled_time = new_mtime + self.settle_policy.changed(path, new_mtime)
                 self.log(
                     "file {} changed since we last looked at it - will revisit after {}s".format(
-                        path, new_mtime + self.config.settle_time - time.time()
+                        path, settled_time - time.time()
                     )
                 )
-                db.record_visit(self.db_conn, path, new_mtime + self.config.settle_time)
+                db.record_visit(self.db_conn, path, settled_time)
                 revisits_queued = True
                 continue
 
-            new_hash, filesize = self.calc_hash(path)
+            new_hash, filesize = await self.hash_file(path)
             if new_hash is None:
                 # Couldn't hash it - drop this file
                 self.log("file {} couldn't be hashed - treat as absent".format(path))
@@ -150,13 +212,16 @@ class Walker:
 
             if new_mtime != mtime:
                 # Changed since we started calculating the hash - revisit when it might have settled
-                db.record_visit(self.db_conn, path, new_mtime + self.config.settle_time)
+                settled_time = new_mtime + self.settle_policy.changed(path, new_mtime)
+                db.record_visit(self.db_conn, path, settled_time)
                 revisits_queued = True
                 continue
 
             # print("updating {} {} {}".format(path, mtime, now))
-            db.update_file_data(self.db_conn, new_hash, filesize, path, mtime, now)
-            db.record_visit(self.db_conn, path)
+            with self.stage_timer.stage("db"):
+                db.update_file_data(self.db_conn, new_hash, filesize, path, mtime, now)
+                db.record_visit(self.db_conn, path)
+            self.settle_policy.settled(path, mtime)
 
         for path in deletes:
             # Check file still doesn't exist
@@ -171,18 +236,47 @@ class Walker:
             except FileNotFoundError:
                 new_mtime = None
             if new_mtime:
-                db.record_visit(self.db_conn, path, new_mtime + self.config.settle_time)
+                settled_time = new_mtime + self.settle_policy.changed(path, new_mtime)
+                db.record_visit(self.db_conn, path, settled_time)
                 revisits_queued = True
             else:
-                db.record_visit(self.db_conn, path, deleted=True)
-                db.update_deleted_file_data(self.db_conn, path, time.time())
-
-        self.db_conn.commit()
+                with self.stage_timer.stage("db"):
+                    db.record_visit(self.db_conn, path, deleted=True)
+                    db.update_deleted_file_data(self.db_conn, path, time.time())
+
+        with self.stage_timer.stage("db"):
+            db.refresh_dir_summaries(self.db_conn, time.time())
+        with self.stage_timer.stage("commit"):
+            self.db_conn.commit()
+        if self.change_feed is not None:
+            self.change_feed.notify()
         return revisits_queued
 
     def visit_symlinks(self, batch):
+        """Record the targets of a batch of symlinks.
+
+        Paths in the batch which are no longer symlinks are recorded as
+        deleted symlinks.  Symlinks don't need to settle, so this never
+        queues revisits.
+
+        """
         for path, mtime in batch:
             self.log("symlink {} mtime={}".format(path, mtime))
+            now = time.time()
+            try:
+                target = os.readlink(path)
+            except OSError:
+                target = None
+
+            if target is None:
+                db.update_deleted_symlink_data(self.db_conn, path, now)
+            else:
+                db.update_symlink_data(self.db_conn, path, target, now)
+                db.record_visit(self.db_conn, path)
+
+        db.refresh_dir_summaries(self.db_conn, time.time())
+        self.db_conn.commit()
+        return False
 
     def listen(self):
         """Listen for updates
@@ -194,6 +288,8 @@ class Walker:
         self.init_delete_batch_processing()
         self.init_file_batch_processing()
         self.init_symlink_batch_processing()
+        self.init_profiling()
+        self.init_change_feed()
 
         self.loop.create_task(self.start_watching_roots())
 
@@ -203,6 +299,47 @@ class Walker:
         self.start_polling_changes()
         self.loop.run_forever()
         self.stop_polling_changes()
+        self.change_feed.stop()
+
+    def init_change_feed(self):
+        """Serve the change log to subscribers, and prune old changes from it."""
+        self.change_feed = feed.ChangeFeed(self.config)
+        self.loop.create_task(self.change_feed.start())
+        self.loop.create_task(self.start_pruning_changes())
+
+    async def start_pruning_changes(self):
+        while True:
+            db.prune_changes(self.db_conn, time.time() - self.change_log_retention)
+            self.db_conn.commit()
+            await asyncio.sleep(3600)
+
+    def init_profiling(self):
+        """Toggle profiling when SIGUSR1 is received.
+
+        Profiling stops after profile_duration seconds, or when a second
+        SIGUSR1 is received.  Results are written to the db directory.
+
+        """
+        self.profile_stop_handle = None
+        self.loop.add_signal_handler(signal.SIGUSR1, self.toggle_profiling)
+
+    def toggle_profiling(self):
+        if self.profiler.running:
+            self.stop_profiling()
+            return
+        self.log("Profiling for {}s".format(self.profile_duration))
+        self.profiler.start()
+        self.profile_stop_handle = self.loop.call_later(
+            self.profile_duration, self.stop_profiling
+        )
+
+    def stop_profiling(self):
+        if self.profile_stop_handle is not None:
+            self.profile_stop_handle.cancel()
+            self.profile_stop_handle = None
+        paths = self.profiler.stop()
+        if paths is not None:
+            self.log("Profile written to {} and {}".format(*paths))
 
     async def process_change(self, path, stats):
         if path is None:
@@ -217,6 +354,8 @@ class Walker:
             await self.add_to_file_batch(path, mtime)
         elif stat.S_ISLNK(stats.st_mode):
             await self.add_to_symlink_batch(path, mtime)
+        elif stat.S_ISDIR(stats.st_mode):
+            self.add_new_dir(path)
         else:
             print("Unexpected change stats: {}".format(str(stats)))
 
@@ -257,9 +396,8 @@ class Walker:
         batch = self.delete_batch
         self.delete_batch = {}
         self.delete_batch_time = None
-        revisits_queued = self.visit_files(
-            sorted(batch.items())
-        ) or self.visit_symlinks(sorted(batch.items()))
+        revisits_queued = await self.visit_files(sorted(batch.items()))
+        revisits_queued = self.visit_symlinks(sorted(batch.items())) or revisits_queued
         if revisits_queued:
             async with self.revisit_cond:
                 self.revisit_cond.notify_all()
@@ -301,7 +439,7 @@ class Walker:
         batch = self.file_batch
         self.file_batch = {}
         self.file_batch_time = None
-        revisits_queued = self.visit_files(
+        revisits_queued = await self.visit_files(
             sorted(batch.items(), key=lambda x: (x[1], x[0]))
         )
         if revisits_queued:
@@ -378,58 +516,445 @@ class Walker:
 
         Applies the exclusions from the config.
 
+        Progress is saved as the walk goes, so if the walker is restarted
+        before the crawl is completed, it carries on from where it got to.
+
         """
-        db.clear_visits(self.db_conn)
+        if not db.crawl_in_progress(self.db_conn):
+            db.clear_visits(self.db_conn)
         for root in self.config.roots:
-            await self.watch_tree(root)
+            await self.crawl_root(os.path.normpath(os.path.realpath(root)))
 
         for path in db.get_unvisited_files(self.db_conn):
             print(path)
             await self.process_change(path, None)
 
-    async def watch_tree(self, root):
-        self.log("Checking files under {}".format(root))
+        for path in db.get_unvisited_symlinks(self.db_conn):
+            await self.process_change(path, None)
 
-        async def watch_dir(base, dirs, files, basefd):
-            skip = []
-            for dirname in dirs:
-                d_path = os.path.normpath(os.path.realpath(os.path.join(base, dirname)))
-                if self.check_skip_dir(d_path, dirname):
-                    skip.append(dirname)
-                else:
-                    self.watch_manager.add_watch(d_path, self.watch_mask)
-                print("D", end="", flush=True)
-                # print();print(d_path)
+        db.clear_crawl_progress(self.db_conn)
+        self.db_conn.commit()
 
-            for dirname in skip:
-                self.log("Skipping {}".format(dirname))
-                dirs.remove(dirname)
+    async def crawl_root(self, root):
+        """Walk a root, watching its directories and processing the items found.
 
-            for name in files:
-                f_path = os.path.normpath(os.path.realpath(os.path.join(base, name)))
+        The frontier of the walk (the directories not yet listed) is saved
+        every checkpoint_interval seconds, after committing everything found
+        so far.  If a saved frontier is found, the walk resumes from it, and
+        the directories listed before the restart are then checked by
+        verify_crawled_dirs rather than being listed again.
 
-                if self.check_skip_file(f_path):
-                    self.log("Skipping {}".format(f_path))
-                    continue
+        """
+        frontier = db.get_crawl_frontier(self.db_conn, root)
+        resumed = frontier is not None
+        if resumed:
+            self.log(
+                "Resuming crawl of {} - {} directories left to list".format(
+                    root, len(frontier)
+                )
+            )
+        else:
+            self.log("Checking files under {}".format(root))
+            db.clear_visits(self.db_conn, root)
+            frontier = []
+            if os.path.isdir(root):
+                if not self.check_skip_dir(root, os.path.basename(root)):
+                    frontier = [root]
+            db.save_crawl_frontier(self.db_conn, root, frontier, time.time())
+            self.db_conn.commit()
+
+        pending = list(frontier)
+        last_checkpoint = time.time()
+        while pending:
+            await self.crawl_dir(pending.pop(), pending)
+            if time.time() - last_checkpoint >= self.checkpoint_interval:
+                await self.checkpoint_crawl(root, pending)
+                last_checkpoint = time.time()
+        await self.checkpoint_crawl(root, pending)
+
+        if resumed:
+            await self.verify_crawled_dirs(root, frontier)
+
+    async def crawl_dir(self, path, pending):
+        """Watch and list a directory, adding its subdirectories to pending."""
+        self.watch(path)
+        with self.stage_timer.stage("crawl"):
+            dir_stats, dirs, others = self.list_dir(path)
+        if dir_stats is None:
+            return
+        db.record_dir_mtime(self.db_conn, path, int(dir_stats.st_mtime), time.time())
+
+        for d_path in dirs:
+            if self.check_skip_dir(d_path, os.path.basename(d_path)):
+                self.log("Skipping {}".format(d_path))
+            else:
+                pending.append(d_path)
+            print("D", end="", flush=True)
+
+        for f_path, stats in others:
+            if self.check_skip_file(f_path):
+                self.log("Skipping {}".format(f_path))
+                continue
+            await self.process_change(f_path, stats)
+            print(".", end="", flush=True)
+
+    async def checkpoint_crawl(self, root, pending):
+        """Commit everything found so far by a crawl, then save its frontier."""
+        if self.file_batch:
+            await self.process_file_batch()
+        if self.symlink_batch:
+            await self.process_symlink_batch()
+        db.save_crawl_frontier(self.db_conn, root, pending, time.time())
+        self.db_conn.commit()
+
+    async def verify_crawled_dirs(self, root, frontier):
+        """Check the directories under root listed before a restart.
 
+        Each directory's mtime is compared with the one recorded when it was
+        listed.  Unchanged directories are just watched again; changed or
+        missing ones are rescanned.  As with rescan_after_overflow, changes
+        to the contents of files in unchanged directories while the walker
+        wasn't running aren't detected.
+
+        """
+        started = time.time()
+        checked = 0
+        # Directories in the frontier, and everything under them, were listed
+        # after the restart.
+        frontier = set(frontier)
+        prefix = root.rstrip("/") + "/"
+        info = db.get_dir_info(self.db_conn, root)
+        page = [] if info is None else [(root, info[1])]
+        after = prefix
+        while True:
+            for path, mtime in page:
+                parent = path
+                while parent != root and parent not in frontier:
+                    parent = os.path.dirname(parent)
+                if parent in frontier:
+                    continue
+                if self.check_skip_dir(path, os.path.basename(path)):
+                    continue
                 try:
-                    stats = os.stat(name, dir_fd=basefd, follow_symlinks=False)
+                    stats = os.stat(path, follow_symlinks=False)
                 except FileNotFoundError:
                     stats = None
-                await self.process_change(f_path, stats)
+                checked += 1
+                if stats is None or int(stats.st_mtime) != mtime:
+                    await self.rescan_dir(path)
+                else:
+                    self.watch(path)
+            await asyncio.sleep(0)
+            page = [
+                row
+                for row in db.get_dirs_page(self.db_conn, after)
+                if row[0].startswith(prefix)
+            ]
+            if len(page) == 0:
+                break
+            after = page[-1][0]
+        self.log(
+            "Checked {} directories under {} in {}s".format(
+                checked, root, time.time() - started
+            )
+        )
+
+    def is_watched(self, path):
+        wd = self.watched.get(path)
+        if wd is None:
+            return False
+        if self.watch_manager.get_path(wd) != path:
+            # The watch has been removed, or the directory moved
+            del self.watched[path]
+            return False
+        return True
+
+    def watch(self, path):
+        """Add a watch on a directory, unless it's already watched."""
+        if self.is_watched(path):
+            return
+        with self.stage_timer.stage("crawl"):
+            wd = self.watch_manager.add_watch(path, self.watch_mask).get(path)
+        if wd is not None and wd >= 0:
+            self.watched[path] = wd
+
+    def unwatched(self, path, wd):
+        """Forget a watch which inotify has removed."""
+        if self.watched.get(path) == wd:
+            del self.watched[path]
+
+    def catching_up(self, path):
+        """Return True if a catch-up scan will list path.
+
+        That's the case if path, or one of its ancestors, has been queued by
+        a catch-up scan but not yet listed.
+
+        """
+        while True:
+            if path in self.catch_up_queued:
+                return True
+            parent = os.path.dirname(path)
+            if parent == path:
+                return False
+            path = parent
+
+    def add_new_dir(self, path):
+        """Start watching a directory which has been created or moved in.
+
+        Directories which are already watched, or which a catch-up scan
+        already in progress will reach, are ignored.  Otherwise, a catch-up
+        scan of the new tree is started in the background, so that other
+        events continue to be processed while it runs.
+
+        """
+        if self.is_watched(path) or self.catching_up(path):
+            return
+        if self.check_skip_dir(path, os.path.basename(path)):
+            self.log("Skipping {}".format(path))
+            return
+        self.log("New directory {} - scanning".format(path))
+        self.catch_up_queued.add(path)
+        self.loop.create_task(self.catch_up_tree(path))
+
+    @staticmethod
+    def list_dir(path):
+        """List a directory, returning (dir_stats, dirs, others).
+
+        dir_stats is the stats of the directory itself, taken before listing
+        it, or None if it doesn't exist.  dirs is a list of subdirectory
+        paths, others a list of (path, stats) for all other entries.  Entries
+        which vanish while being listed are left out.
+
+        """
+        dirs = []
+        others = []
+        try:
+            dir_stats = os.stat(path, follow_symlinks=False)
+        except FileNotFoundError:
+            return None, dirs, others
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    try:
+                        stats = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    if stat.S_ISDIR(stats.st_mode):
+                        dirs.append(entry.path)
+                    else:
+                        others.append((entry.path, stats))
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            pass
+        return dir_stats, dirs, others
+
+    async def catch_up_dir(self, path):
+        """Watch and list a single directory of a catch-up scan.
+
+        The watch is added before listing, so any file created during the
+        scan is reported by either the listing or inotify.  The directory
+        stops counting as queued at the same point, so events for entries
+        created during the listing aren't ignored by add_new_dir.
+
+        """
+        async with self.catch_up_limit:
+            self.catch_up_queued.discard(path)
+            self.watch(path)
+            return await self.loop.run_in_executor(None, self.list_dir, path)
+
+    async def catch_up_tree(self, root):
+        """Watch and index all the contents of a newly appeared directory.
 
-                print(".", end="", flush=True)
+        Directories are listed in parallel in worker threads, up to
+        catch_up_parallelism at a time across all catch-up scans, and the
+        files found are fed into the normal batches.
+
+        """
+        pending = [root]
+        chunk = []
+        try:
+            while pending:
+                chunk = pending[: self.catch_up_parallelism]
+                del pending[: self.catch_up_parallelism]
+                listings = await asyncio.gather(
+                    *(self.catch_up_dir(path) for path in chunk)
+                )
+                for path, (dir_stats, dirs, others) in zip(chunk, listings):
+                    if dir_stats is not None:
+                        db.record_dir_mtime(
+                            self.db_conn, path, int(dir_stats.st_mtime), time.time()
+                        )
+                    for d_path in dirs:
+                        if self.check_skip_dir(d_path, os.path.basename(d_path)):
+                            self.log("Skipping {}".format(d_path))
+                        elif self.is_watched(d_path) or d_path in self.catch_up_queued:
+                            # Already reached by a scan started from an event
+                            continue
+                        else:
+                            self.catch_up_queued.add(d_path)
+                            pending.append(d_path)
+                    for f_path, stats in others:
+                        if self.check_skip_file(f_path):
+                            self.log("Skipping {}".format(f_path))
+                            continue
+                        await self.process_change(f_path, stats)
+                # Let queued inotify events be handled between chunks
+                await asyncio.sleep(0)
+        finally:
+            # Don't leave directories this scan won't list marked as queued
+            self.catch_up_queued.difference_update(chunk)
+            self.catch_up_queued.difference_update(pending)
+        self.log("Finished scanning new directory {}".format(root))
+
+    async def rescan_dir(self, path):
+        """Bring the stored state of a single directory up to date.
+
+        New subdirectories get a catch-up scan, and stored files which are
+        no longer present are deleted.  Returns the number of entries listed.
 
+        """
         try:
-            d_path = os.path.normpath(os.path.realpath(root))
-            if os.path.isdir(d_path):
-                if not self.check_skip_dir(d_path, os.path.basename(d_path)):
-                    self.watch_manager.add_watch(d_path, self.watch_mask)
+            is_dir = stat.S_ISDIR(os.lstat(path).st_mode)
+        except FileNotFoundError:
+            is_dir = False
+        if not is_dir:
+            return await self.forget_dir(path)
+
+        dir_stats, dirs, others = await self.catch_up_dir(path)
+        if dir_stats is not None:
+            db.record_dir_mtime(
+                self.db_conn, path, int(dir_stats.st_mtime), time.time()
+            )
+        for d_path in dirs:
+            self.add_new_dir(d_path)
+
+        seen = set()
+        for f_path, stats in others:
+            if self.check_skip_file(f_path):
+                continue
+            seen.add(f_path)
+            await self.process_change(f_path, stats)
+        for f_path in db.get_current_paths_in_dir(self.db_conn, path):
+            if f_path not in seen:
+                await self.process_change(f_path, None)
+        return len(dirs) + len(others)
+
+    async def forget_dir(self, path):
+        """Record that a directory and everything stored under it are gone.
+
+        The stored files and symlinks are queued for the delete pass, and the
+        directories are marked deleted, so they're no longer stat'ed or
+        watched by later rescans.  Returns the number of entries forgotten.
+
+        """
+        operations = 0
+        subdirs = [path]
+        after = path + "/"
+        while True:
+            page = db.get_dirs_page(self.db_conn, after)
+            page = [d_path for d_path, _ in page if db.is_under(d_path, [path])]
+            if len(page) == 0:
+                break
+            after = page[-1]
+            subdirs.extend(page)
+
+        now = time.time()
+        for d_path in subdirs:
+            for f_path in db.get_current_paths_in_dir(self.db_conn, d_path):
+                await self.process_change(f_path, None)
+                operations += 1
+            db.update_deleted_dir_data(self.db_conn, d_path, now)
+            operations += 1
+        return operations
+
+    def note_activity(self, path):
+        """Remember that there was recent activity in a directory."""
+        self.recent_dirs[path] = time.time()
+        self.recent_dirs.move_to_end(path)
+        if len(self.recent_dirs) > self.max_recent_dirs:
+            self.recent_dirs.popitem(last=False)
+
+    def real_roots(self):
+        return [os.path.normpath(os.path.realpath(root)) for root in self.config.roots]
+
+    def start_overflow_rescan(self):
+        if self.overflow_rescan is not None and not self.overflow_rescan.done():
+            self.overflow_again = True
+            return
+        self.overflow_rescan = self.loop.create_task(self.rescan_after_overflow())
+
+    async def rescan_after_overflow(self):
+        """Find changes which may have been missed when the inotify queue
+        overflowed.
+
+        Directories with recent activity are rescanned first, most recent
+        first, as that's where events were most likely lost.  Then the mtime
+        of every stored directory under the roots is compared with the one
+        recorded when it was last listed, and changed directories are
+        rescanned, which catches files created, deleted or renamed anywhere.
+        Changes to the contents of files outside recently active directories
+        aren't detected.
 
-            for base, dirs, files, basefd in os.fwalk(root, follow_symlinks=False):
-                await watch_dir(base, dirs, files, basefd)
-        except FileNotFoundError as e:
-            self.log("File not found - aborting scan of root {}".format(root))
+        The work is paced to about rescan_rate stats or listed entries per
+        second.
+
+        """
+        while True:
+            self.overflow_again = False
+            started = time.time()
+            operations = 0
+            rescanned = set()
+
+            for path in reversed(list(self.recent_dirs)):
+                operations += await self.rescan_dir(path)
+                rescanned.add(path)
+                operations = await self.pace_rescan(operations)
+
+            roots = self.real_roots()
+            skipped = set()
+            after = ""
+            while True:
+                page = db.get_dirs_page(self.db_conn, after)
+                if len(page) == 0:
+                    break
+                after = page[-1][0]
+                for path, mtime in page:
+                    if path in rescanned or not db.is_under(path, roots):
+                        continue
+                    # Parents sort before their children, so this skips the
+                    # whole of an excluded or vanished tree.
+                    if os.path.dirname(path) in skipped or self.check_skip_dir(
+                        path, os.path.basename(path)
+                    ):
+                        skipped.add(path)
+                        continue
+                    try:
+                        stats = os.stat(path, follow_symlinks=False)
+                    except FileNotFoundError:
+                        stats = None
+                    operations += 1
+                    if stats is None:
+                        operations += await self.forget_dir(path)
+                        skipped.add(path)
+                    elif int(stats.st_mtime) != mtime:
+                        operations += await self.rescan_dir(path)
+                    operations = await self.pace_rescan(operations)
+
+            self.log(
+                "Rescan after inotify overflow took {}s".format(time.time() - started)
+            )
+            if not self.overflow_again:
+                break
+
+    async def pace_rescan(self, operations):
+        """Sleep to keep a rescan to rescan_rate operations per second.
+
+        Returns the number of operations not yet paid for.
+
+        """
+        if operations < 100:
+            return operations
+        await asyncio.sleep(operations / self.rescan_rate)
+        return 0
 
     async def start_polling_revisits(self):
         """Start task that triggers revisiting of paths that hadn't settled
@@ -462,12 +987,29 @@ class Walker:
 
     def start_polling_changes(self):
         def process_inotify_event(event):
+            if event.mask & pyinotify.IN_Q_OVERFLOW:
+                self.log("inotify queue overflowed - starting rescan")
+                self.start_overflow_rescan()
+                return
+            if event.mask & pyinotify.IN_IGNORED:
+                self.unwatched(event.path, event.wd)
+            self.note_activity(os.path.dirname(event.pathname))
+
             async def task():
                 print("EVENT: {}".format(str(event)))
                 try:
                     stats = os.stat(event.pathname, follow_symlinks=False)
                 except FileNotFoundError:
                     stats = None
+                if (
+                    stats is None
+                    and event.dir
+                    and event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM)
+                ):
+                    # Everything stored under a deleted or moved directory has
+                    # gone too; a move into the tree is picked up at its new path.
+                    await self.forget_dir(event.pathname)
+                    return
                 await self.process_change(event.pathname, stats)
 
             self.loop.create_task(task())
@@ -483,4 +1025,4 @@ class Walker:
 if __name__ == "__main__":
     import config
 
-    Walker(config.config).listen()
+    Walker(config.get_config()).listen()
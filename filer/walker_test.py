@@ -0,0 +1,298 @@
+from . import bench
+from . import db
+from . import symlinks
+from . import throttle
+import os
+import pytest
+import shutil
+import threading
+
+pytest.importorskip("pyinotify")
+
+
+@pytest.fixture
+def make_walker(tmp_path):
+    """Return a function making walkers over tmp_path/root, sharing a db."""
+    root = tmp_path / "root"
+    root.mkdir()
+    walkers = []
+
+    def make():
+        walker = bench.make_walker(bench.make_config(str(root), str(tmp_path / "db")))
+        walkers.append(walker)
+        return walker
+
+    yield make
+    for walker in walkers:
+        if not walker.loop.is_closed():
+            bench.close_walker(walker)
+
+
+def crawl(walker):
+    walker.loop.run_until_complete(walker.start_watching_roots())
+    bench.flush_batches(walker)
+
+
+def test_crawl_records_symlinks(tmp_path, make_walker):
+    root = tmp_path / "root"
+    (root / "real").mkdir()
+    (root / "real" / "f").write_text("x")
+    os.symlink("real", str(root / "link"))
+
+    walker = make_walker()
+    crawl(walker)
+    assert list(db.get_current_symlinks(walker.db_conn)) == [
+        (str(root / "link"), "real")
+    ]
+    found = symlinks.SymlinkResolver(walker.db_conn).lookup([str(root / "link" / "f")])
+    assert found[str(root / "link" / "f")][1] == str(root / "real" / "f")
+    bench.close_walker(walker)
+
+    # A restart doesn't treat the symlink as deleted.
+    walker = make_walker()
+    crawl(walker)
+    assert list(db.get_current_symlinks(walker.db_conn)) == [
+        (str(root / "link"), "real")
+    ]
+
+
+def wait_for(walker, is_done, timeout=10):
+    bench.run_until_quiet(walker.loop, is_done, timeout)
+    assert is_done()
+
+
+def current_files(walker):
+    bench.flush_batches(walker)
+    return sorted(
+        row[0]
+        for row in walker.db_conn.execute(
+            "select path from files where deleted_before is null"
+        )
+    )
+
+
+def test_catch_up_new_tree(tmp_path, make_walker):
+    root = tmp_path / "root"
+    walker = make_walker()
+    crawl(walker)
+    walker.start_polling_changes()
+
+    os.makedirs(str(root / "a" / "b" / "c"))
+    for path in ("a/1", "a/b/2", "a/b/c/3"):
+        (root / path).write_text(path)
+    wait_for(walker, lambda: walker.is_watched(str(root / "a" / "b" / "c")))
+    walker.loop.run_until_complete(bench.asyncio.sleep(0.2))
+    assert current_files(walker) == [
+        str(root / path) for path in ("a/1", "a/b/2", "a/b/c/3")
+    ]
+
+
+def test_catch_up_sees_dirs_made_while_listing(tmp_path, make_walker):
+    """A subdirectory created just after its parent is listed (as with
+    mkdir -p) is scanned from its inotify event."""
+    root = tmp_path / "root"
+    walker = make_walker()
+    crawl(walker)
+    walker.start_polling_changes()
+    list_dir = walker.list_dir
+
+    def list_then_create(path):
+        listing = list_dir(path)
+        if path == str(root / "a"):
+            os.makedirs(str(root / "a" / "b" / "c"))
+            (root / "a" / "b" / "c" / "f").write_text("f")
+        return listing
+
+    walker.list_dir = list_then_create
+    os.mkdir(str(root / "a"))
+    wait_for(walker, lambda: walker.is_watched(str(root / "a" / "b" / "c")))
+    walker.loop.run_until_complete(bench.asyncio.sleep(0.2))
+    assert current_files(walker) == [str(root / "a" / "b" / "c" / "f")]
+
+
+def test_nested_new_dirs_scanned_once(tmp_path, make_walker):
+    root = tmp_path / "root"
+    walker = make_walker()
+    crawl(walker)
+    os.makedirs(str(root / "a" / "b" / "c"))
+    (root / "a" / "b" / "c" / "f").write_text("f")
+
+    listed = []
+    list_dir = walker.list_dir
+
+    def counting_list_dir(path):
+        listed.append(path)
+        return list_dir(path)
+
+    walker.list_dir = counting_list_dir
+    # As for IN_CREATE events arriving for each level during the scan.
+    for path in ("a", "a/b", "a/b/c"):
+        walker.add_new_dir(str(root / path))
+    assert walker.catch_up_queued == {str(root / "a")}
+    wait_for(walker, lambda: len(walker.catch_up_queued) == 0 and len(listed) == 3)
+    walker.loop.run_until_complete(bench.asyncio.sleep(0.1))
+    assert sorted(listed) == [str(root / path) for path in ("a", "a/b", "a/b/c")]
+    assert current_files(walker) == [str(root / "a" / "b" / "c" / "f")]
+
+
+def test_deleted_tree_is_forgotten(tmp_path, make_walker):
+    root = tmp_path / "root"
+    for path in ("a/f", "a/sub/g", "b/f"):
+        os.makedirs(str((root / path).parent), exist_ok=True)
+        (root / path).write_text(path[-1])
+    walker = make_walker()
+    crawl(walker)
+    walker.start_polling_changes()
+    a, b = str(root / "a"), str(root / "b")
+    assert list(db.diff_dirs(walker.db_conn, a, b)) == [("sub", "removed")]
+
+    shutil.rmtree(str(root / "a" / "sub"))
+    wait_for(walker, lambda: db.get_dir_summary(walker.db_conn, a + "/sub") is None)
+    assert current_files(walker) == [a + "/f", b + "/f"]
+    assert list(db.diff_dirs(walker.db_conn, a, b)) == []
+    assert (
+        db.get_dir_summary(walker.db_conn, a)[0]
+        == db.get_dir_summary(walker.db_conn, b)[0]
+    )
+    assert list(db.get_duplicate_dirs(walker.db_conn)) == [[a, b]]
+
+
+def test_tree_moved_within_roots(tmp_path, make_walker):
+    root = tmp_path / "root"
+    for path in ("a/sub/f", "a/sub/deep/g", "b/h"):
+        os.makedirs(str((root / path).parent), exist_ok=True)
+        (root / path).write_text(path)
+    walker = make_walker()
+    crawl(walker)
+    walker.start_polling_changes()
+
+    os.rename(str(root / "a" / "sub"), str(root / "b" / "sub"))
+    old, new = str(root / "a" / "sub"), str(root / "b" / "sub")
+    wait_for(
+        walker,
+        lambda: db.get_dir_summary(walker.db_conn, old + "/deep") is None
+        and db.get_dir_summary(walker.db_conn, new + "/deep") is not None,
+    )
+    assert db.get_dir_summary(walker.db_conn, old) is None
+    assert current_files(walker) == [
+        str(root / path) for path in ("b/h", "b/sub/deep/g", "b/sub/f")
+    ]
+    assert list(db.get_duplicate_files(walker.db_conn, 0)) == []
+
+
+def test_overflow_rescan_skips_excluded_and_forgets_vanished_dirs(
+    tmp_path, make_walker
+):
+    root = tmp_path / "root"
+    for path in ("keep/f", "gone/sub/g", "skip/sub/h"):
+        os.makedirs(str((root / path).parent), exist_ok=True)
+        (root / path).write_text(path)
+    walker = make_walker()
+    crawl(walker)
+    bench.close_walker(walker)
+
+    shutil.rmtree(str(root / "gone"))
+    (root / "skip" / "sub" / "new").write_text("new")
+    walker = make_walker()
+    walker.config = walker.config._replace(exclude_directories=["skip"])
+    calls = []
+    for name in ("rescan_dir", "forget_dir"):
+
+        async def recording(path, name=name, method=getattr(walker, name)):
+            calls.append((name, path))
+            return await method(path)
+
+        setattr(walker, name, recording)
+
+    walker.loop.run_until_complete(walker.rescan_after_overflow())
+    assert calls == [("forget_dir", str(root / "gone"))]
+    assert not walker.is_watched(str(root / "gone"))
+    assert not walker.is_watched(str(root / "skip" / "sub"))
+    assert current_files(walker) == [
+        str(root / "keep" / "f"),
+        str(root / "skip" / "sub" / "h"),
+    ]
+    walker.db_conn.commit()
+
+    # The vanished directories are no longer checked at all.
+    del calls[:]
+    walker.loop.run_until_complete(walker.rescan_after_overflow())
+    assert calls == []
+
+
+def test_throttled_hashing_sleeps_off_the_loop_thread(tmp_path, make_walker):
+    root = tmp_path / "root"
+    for name in ("a", "b", "c"):
+        (root / name).write_text(name)
+    walker = make_walker()
+    io_config = walker.config.io._replace(files_per_second=1)
+    sleeps = []
+    walker.io_throttle = throttle.IOThrottle(
+        io_config, sleep=lambda delay: sleeps.append(threading.current_thread())
+    )
+    crawl(walker)
+    assert len(sleeps) > 0
+    assert threading.main_thread() not in sleeps
+    assert current_files(walker) == [str(root / name) for name in ("a", "b", "c")]
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_interrupted_crawl_resumes_from_checkpoint(tmp_path, make_walker):
+    root = tmp_path / "root"
+    for name in ("a", "b", "c"):
+        (root / name).mkdir()
+        (root / name / "f").write_text(name)
+    all_dirs = sorted(str(root / name) for name in ("", "a", "b", "c"))
+
+    walker = make_walker()
+    walker.checkpoint_interval = 0
+    listed = []
+    crawl_dir = walker.crawl_dir
+
+    async def interrupted_crawl_dir(path, pending):
+        if len(listed) == 2:
+            raise Interrupted()
+        listed.append(path)
+        await crawl_dir(path, pending)
+
+    walker.crawl_dir = interrupted_crawl_dir
+    with pytest.raises(Interrupted):
+        walker.loop.run_until_complete(walker.start_watching_roots())
+    # Everything found before the last checkpoint is committed.
+    frontier = db.get_crawl_frontier(walker.db_conn, str(root))
+    assert sorted(frontier + listed) == all_dirs
+    bench.close_walker(walker)
+    conn = db.connect(walker.config)
+    assert db.crawl_in_progress(conn)
+    assert len(list(db.get_file_records(conn))) == 1
+    conn.close()
+
+    # A directory listed before the restart changes while the walker is down.
+    changed = listed[1]
+    with open(os.path.join(changed, "new"), "w") as fobj:
+        fobj.write("new")
+    old_mtime = os.stat(changed).st_mtime - 10
+    os.utime(changed, (old_mtime, old_mtime))
+
+    walker = make_walker()
+    calls = []
+    for name in ("crawl_dir", "rescan_dir"):
+
+        async def recording(path, *args, name=name, method=getattr(walker, name)):
+            calls.append((name, path))
+            return await method(path, *args)
+
+        setattr(walker, name, recording)
+    crawl(walker)
+    assert sorted(calls) == sorted(
+        [("crawl_dir", path) for path in frontier] + [("rescan_dir", changed)]
+    )
+    assert all(walker.is_watched(path) for path in all_dirs)
+    assert not db.crawl_in_progress(walker.db_conn)
+    assert current_files(walker) == sorted(
+        [str(root / name / "f") for name in ("a", "b", "c")]
+        + [os.path.join(changed, "new")]
+    )
@@ -0,0 +1,7 @@
+#/usr/bin/env python
+
+import sys
+
+from filer import federate
+
+sys.exit(federate.run())
@@ -0,0 +1,5 @@
+#/usr/bin/env python
+
+from filer import fs
+
+fs.run()
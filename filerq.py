@@ -0,0 +1,7 @@
+#/usr/bin/env python
+
+import sys
+
+from filer import query
+
+sys.exit(query.run())